@@ -17,11 +17,24 @@
 # License along with this library.
 
 import os
+import re
+import stat
+import posixpath
+import urllib.parse
 import shutil
+import filecmp
 from functools import reduce
 import textile
 import json
 import logging
+import hashlib
+import pickle
+import collections
+import contextlib
+import asyncio
+import concurrent.futures
+from appie.profiler import AppieProfiler, AppieSample
+from appie.compress import compress_output, remove_sidecars
 
 import pprint
 
@@ -36,7 +49,19 @@ logger = logging.getLogger(__name__)
 
 config = {
     'target': "./build", 
-    'src': "./site_src" 
+    'src': "./site_src",
+    'jobs': 1,              # number of processes used for parsing files
+    'cache': None,          # build state file, defaults to the buildroot
+    'output': 'json',       # 'json' for all.json, 'shards' for json shards
+    'shard_depth': None,    # directory depth to shard, None for all
+    'stream': False,        # write all.json while parsing
+    'publish': 'copy',      # how files are published to the buildroot
+    'profile': False,       # collect timings of the build in Appie.profiler
+    'url': '',              # base url of the site, used in feeds
+    'async': False,         # overlap the file system I/O of the build
+    'io_limit': 32,         # max number of concurrent I/O operations (async)
+    'compress': False,      # write .gz (and .br) sidecars of text files
+    'compress_jobs': None   # threads compressing sidecars, None for all cores
 } 
 
 def mergedicts(dict1, dict2):
@@ -55,7 +80,736 @@ def mergedicts(dict1, dict2):
             yield (k, dict2[k])
 
 
-class AppieDirParser(object):
+def file_md5(path):
+    """
+    Returns the md5 hexdigest of a file's content
+
+    :param str path: path of the file
+    """
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# attributes named src or href, not data-src and the like
+_html_links = re.compile(r"""(?:^|\s)(?:src|href)\s*=\s*["']([^"'#?]+)""", re.I)
+
+
+def html_links(html):
+    """
+    Returns the local links (src and href attributes) in a html document,
+    without their query and fragment. Links to other sites are skipped.
+
+    :param str html: the html document
+    """
+    links = []
+    for link in _html_links.findall(html):
+        link = link.strip()
+        if not link or '://' in link or link.startswith(('//', 'mailto:',
+                                        'data:', 'javascript:', 'tel:')):
+            continue
+        if link not in links:
+            links.append(link)
+    return links
+
+
+def resolve_link(link, web_path):
+    """
+    Returns the path in the buildroot a link in a page points to
+
+    :param str link: the link as written in the page
+    :param str web_path: relative path of the page's directory in the
+                         buildroot
+    """
+    link = urllib.parse.unquote(link)
+    if link.startswith('/'):
+        return posixpath.normpath(link.lstrip('/'))
+    return posixpath.normpath(posixpath.join(web_path, link))
+
+
+def _clone_file(path, dest):
+    """
+    Copy a file using a copy on write clone if the filesystem supports it,
+    otherwise copy_file_range or a plain copy
+    """
+    with open(path, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        try:
+            import fcntl
+            # FICLONE from linux/fs.h
+            fcntl.ioctl(fdst.fileno(), getattr(fcntl, 'FICLONE', 0x40049409),
+                        fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        try:
+            size = os.fstat(fsrc.fileno()).st_size
+            while size > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size)
+                if copied == 0:
+                    break
+                size -= copied
+            if size <= 0:
+                return
+        except (AttributeError, OSError):
+            pass
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def publish_file(path, dest_path, method=None, name=None):
+    """
+    Publish a file to a directory in the buildroot using one of the
+    following methods:
+
+    * copy: copy the file (default)
+    * changed: only copy if the published file differs in content
+    * hardlink: hardlink the file, copies if not on the same filesystem
+    * reflink: clone the file if the filesystem supports it (copy on
+      write), otherwise copy it
+    * symlink: symlink to the absolute path of the file
+
+    :param str path: path of the file
+    :param str dest_path: path of the destination directory
+    :param str method: the method, defaults to config['publish']
+    :param str name: the filename in dest_path, defaults to the filename
+                     of path
+    Returns the path of the published file
+    """
+    method = method or config.get('publish') or 'copy'
+    dest = os.path.join(dest_path, name or os.path.basename(path))
+    if os.path.islink(dest):
+        if method == 'symlink' and os.readlink(dest) == os.path.abspath(path):
+            return dest
+        os.remove(dest)     # never write through a link into the source
+    elif os.path.exists(dest):
+        if os.path.samefile(path, dest):
+            if method == 'hardlink':
+                return dest
+            os.remove(dest)
+        elif method == 'changed' and filecmp.cmp(path, dest, shallow=False):
+            return dest
+        elif method in ('hardlink', 'reflink', 'symlink'):
+            os.remove(dest)
+
+    if method == 'hardlink':
+        try:
+            os.link(path, dest)
+            return dest
+        except OSError:
+            logger.debug("Can't hardlink {0}, copying instead".format(path))
+    elif method == 'symlink':
+        os.symlink(os.path.abspath(path), dest)
+        return dest
+    elif method == 'reflink':
+        _clone_file(path, dest)
+        shutil.copymode(path, dest)
+        return dest
+    return shutil.copy(path, dest)
+
+
+def _init_worker(cfg):
+    """
+    Initialize a worker process with the config of the main process
+    """
+    config.update(cfg)
+
+
+# build state record of a parsed file, outputs are the paths in the
+# buildroot it produced, refs the paths in the buildroot its outputs link to
+# and deps the other source files (i.e. templates) its outputs depend on
+AppieRecord = collections.namedtuple('AppieRecord',
+                                     'mtime size md5 parser outputs refs deps')
+AppieRecord.__new__.__defaults__ = ((), ())
+
+
+def parse_file_job(parser, path, filename, dest_path, web_path, st):
+    """
+    Parse a single file and copy it to the build dir if the parser wants
+    to. When building with multiple jobs this runs in a worker process so
+    it must only depend on its (picklable) arguments.
+
+    :param parser: the file parser instance
+    :param str path: path of the file
+    :param str filename: name of the file
+    :param str dest_path: path of the destination directory
+    :param str web_path: relative path of the destination in the buildroot
+    :param os.stat_result st: stat result of the file
+    Returns a tuple of the dictionary of the file, its build state record
+    and its profiler sample (None if not profiling)
+    """
+    sample = AppieSample(path, type(parser).__name__) \
+                if config.get('profile') else None
+    if sample:
+        with sample.step('hash'):
+            md5 = file_md5(path)
+        with sample.step('parse'):
+            d = parser.parse_file( path, filename, dest_path )
+    else:
+        md5 = file_md5(path)
+        d = parser.parse_file( path, filename, dest_path )
+    d['path'] = web_path
+    d['mtime'] = st.st_mtime
+    if 'md5' in d:
+        d['md5'] = md5      # parsers leave the md5 key for us to fill in
+    outputs = parser.outputs( filename, d )
+    # copy file to dest if no content key
+    if not d.get( 'content' ) and parser.copyfile:
+        logging.debug("Copy file {0} to the directory {1}"\
+                        .format(path, dest_path))
+        if sample:
+            with sample.step('publish'):
+                publish_file(path, dest_path)
+        else:
+            publish_file(path, dest_path)
+        outputs.append(filename)
+    refs = [ resolve_link(link, web_path) for link in
+                        parser.references( filename, d, dest_path ) ]
+    record = AppieRecord( st.st_mtime, st.st_size, md5, parser.cache_key(),
+                    [ web_path + '/' + f if web_path else f for f in outputs ],
+                    refs )
+    return d, (path, record), sample and sample.stop()
+
+
+class AppieBuildCache(object):
+    """
+    Persistent state of the previous run, saved as a binary file next to
+    the build. It contains:
+
+    * records: an AppieRecord of every parsed file by its path with its
+      mtime, size, content hash, the identity of its parser including its
+      settings, the paths of its outputs, the paths its outputs link to and
+      the other source files it depends on. Together these form the
+      dependency graph of the site.
+    * tree: the AppieSnapshot of the sources
+    * settings: the settings of the build (parsers, output)
+    * sidecars: the state of the compressed files in the buildroot, see
+      appie.compress.compress_output
+
+    A file is only considered modified if its content or its parser
+    changed. Touching a file (checkout, rsync, etc) just causes it to be
+    hashed again. If the tree and settings did not change at all the
+    build can be skipped without loading the previous output.
+    """
+    version = 5
+
+    def __init__(self, filepath):
+        """
+        :param str filepath: path of the state file
+        """
+        self.filepath = filepath
+        self.records = {}
+        self.tree = None
+        self.settings = None
+        self.sidecars = {}
+        self.seen = set()   # paths checked or updated during this run
+        self.kept = set()   # unchanged directories reused as a whole
+        self.stale = set()  # outputs of the previous run no longer produced
+        self.touched = set()    # outputs written or removed during this run
+
+    def load(self):
+        """
+        Load the state of a previous run if available
+        """
+        try:
+            with open(self.filepath, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        if state.get('version') != self.version:
+            return
+        self.records = state['records']
+        self.tree = state['tree']
+        self.settings = state['settings']
+        self.sidecars = state['sidecars']
+
+    def save(self, prune=True):
+        """
+        Save the state
+
+        :param bool prune: drop records of files not seen during this run
+        """
+        if prune:
+            self.prune()
+        state = {
+            'version': self.version,
+            'records': self.records,
+            'tree': self.tree,
+            'settings': self.settings,
+            'sidecars': self.sidecars
+        }
+        with open(self.filepath, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+    def prune(self):
+        """
+        Drop the records of files not seen during this run, their outputs
+        become stale
+        """
+        for path in [ p for p in self.records
+                      if p not in self.seen and not self.is_kept(p) ]:
+            self.stale.update(self.records.pop(path).outputs)
+
+    def keep(self, path):
+        """
+        Keep the records of all files in an unchanged directory which is
+        reused without checking its files
+
+        :param str path: path of the directory
+        """
+        self.kept.add(path)
+
+    def is_kept(self, path):
+        """
+        Returns true if path is in a directory kept during this run
+
+        :param str path: path of a file
+        """
+        while self.kept:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            if parent in self.kept:
+                return True
+            path = parent
+        return False
+
+    def update(self, path, record):
+        """
+        Store the record of a parsed file
+
+        :param str path: path of the file
+        :param AppieRecord record: the record of the file
+        """
+        self.seen.add(path)
+        old = self.records.get(path)
+        if old:
+            self.stale.update(set(old.outputs).difference(record.outputs))
+            self.touched.update(old.outputs)
+        self.touched.update(record.outputs)
+        self.records[path] = record
+
+    def remove(self, path):
+        """
+        Drop the records of a removed file or of all files in a removed
+        directory, their outputs become stale. Returns the removed records
+        by path.
+
+        :param str path: path of the file or directory
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        removed = { p: r for p, r in self.records.items()
+                    if p == path or p.startswith(prefix) }
+        for p, r in removed.items():
+            del self.records[p]
+            self.stale.update(r.outputs)
+            self.touched.update(r.outputs)
+        return removed
+
+    def stale_outputs(self):
+        """
+        Returns the sorted stale outputs which are not produced by another
+        file (i.e. by the same file in another source directory)
+        """
+        live = { o for rec in self.records.values() for o in rec.outputs }
+        return sorted(self.stale - live)
+
+    def is_modified(self, path, st, parser):
+        """
+        Check whether a file needs to be parsed again
+
+        :param str path: path of the file
+        :param os.stat_result st: stat result of the file
+        :param parser: the parser matching the file or its cache key
+        Returns true if modified
+        """
+        self.seen.add(path)
+        rec = self.records.get(path)
+        key = parser if isinstance(parser, str) else parser.cache_key()
+        if not rec or rec.parser != key:
+            return True
+        if rec.size != st.st_size:
+            return True
+        if rec.mtime == st.st_mtime:
+            return False
+        # mtime changed, only the content can tell us
+        if rec.md5 != file_md5(path):
+            return True
+        self.records[path] = rec._replace(mtime=st.st_mtime)
+        return False
+
+    def dependents(self, path):
+        """
+        Returns the paths of the files linking to an output of path or
+        depending on path (i.e. posts using a template)
+
+        :param str path: path of a source file
+        """
+        rec = self.records.get(path)
+        outputs = set(rec.outputs) if rec else set()
+        return sorted( p for p, r in self.records.items() if p != path and
+                       (outputs.intersection(r.refs) or path in r.deps) )
+
+    def broken_links(self, target, sources=()):
+        """
+        Returns a sorted list of (path, link) tuples of the links in the
+        outputs of the files which don't point to an output of the build or
+        an entry of the site's dictionary
+
+        :param str target: the buildroot
+        :param list sources: the source directories
+        """
+        outputs = { o for rec in self.records.values() for o in rec.outputs }
+        # the entries of parsed files in all.json, i.e. home.textile
+        for path in self.records:
+            for src in sources:
+                rel = os.path.relpath(path, src)
+                if not rel.startswith(os.pardir):
+                    outputs.add(rel.replace(os.sep, '/'))
+        broken = []
+        for path, rec in sorted(self.records.items()):
+            for ref in rec.refs:
+                # directories and files like all.json have no record
+                if ref not in outputs and \
+                        not os.path.exists(os.path.join(target, ref)):
+                    broken.append((path, ref))
+        return broken
+
+
+class AppieDirEntry(object):
+    """
+    Minimal os.DirEntry lookalike for a single path, used when parsing
+    separate paths instead of scanning a directory and for the entries
+    of an AppieSnapshot
+    """
+    __slots__ = ('path', 'name', '_stat')
+
+    def __init__(self, path, st=None):
+        """
+        :param str path: path of the file or directory
+        :param st: stat result of the path if already known
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self._stat = st
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.stat().st_mode)
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+# stat data of a path in an AppieSnapshot, named like os.stat_result
+AppieStat = collections.namedtuple('AppieStat', 'st_mode st_ino st_size st_mtime')
+
+# paths which differ between two snapshots
+AppieSnapshotDiff = collections.namedtuple('AppieSnapshotDiff',
+                                           'added removed modified')
+
+
+class AppieSnapshot(object):
+    """
+    The type, inode, size and mtime of every file and directory in the
+    source directories, made in a single pass. During a build the
+    directories are listed from the snapshot, so every path is only
+    stat'ed once for both change detection and the mtime in the output.
+    The snapshot is saved with the build state and diffed against the
+    snapshot of the next run.
+
+    Multiple sources are overlaid: an entry in a later source overrides
+    the entry with the same relative path in an earlier source, except
+    that directories in several sources are merged. A merged directory
+    is listed under its path in the last source containing it, so every
+    path of the site is parsed once.
+
+    Every directory has a fingerprint of its subtree, a hash of the names
+    and stat data of its entries and the fingerprints of its
+    subdirectories. A directory with the same fingerprint as in the
+    previous snapshot is unchanged.
+    """
+    def __init__(self, roots=()):
+        """
+        :param list roots: the source directories
+        """
+        self.roots = list(roots)
+        self.entries = {}   # path: AppieStat of every path in every source
+        self.children = {}  # directory path: list of AppieDirEntry
+        self.fingerprints = {}  # directory path: md5 of its subtree
+        self.layers = {}    # path of a merged directory: paths in the sources
+
+    @classmethod
+    def scan(cls, sources):
+        """
+        Returns the snapshot of the overlay of the source directories
+
+        :param list sources: the source directories, in order of precedence
+        """
+        snapshot = cls(sources)
+        if sources:
+            snapshot._scan_dir(list(sources))
+        return snapshot
+
+    @property
+    def root(self):
+        """
+        The path under which the root of the overlay is listed
+        """
+        return self.roots[-1]
+
+    def _scan_dir(self, layers):
+        found = {}  # name: entries in the order of the sources
+        for layer in layers:
+            for item in os.scandir(layer):
+                st = item.stat()
+                entry = AppieDirEntry(item.path, AppieStat(st.st_mode,
+                                        st.st_ino, st.st_size, st.st_mtime))
+                self.entries[item.path] = entry._stat
+                found.setdefault(item.name, []).append(entry)
+        path = layers[-1]
+        if len(layers) > 1:
+            self.layers[path] = layers
+        items = self.children[path] = [ e[-1] for e in found.values() ]
+        h = hashlib.md5()
+        # recurse after the directory is closed to limit open descriptors
+        for entry in sorted(items, key=lambda e: e.name):
+            st = entry._stat
+            # the path tells which source the entry is from
+            h.update("{0}\0{1}\0{2}\0{3!r}\0".format(entry.path, st.st_mode,
+                        st.st_size, st.st_mtime).encode('utf-8', 'surrogateescape'))
+            if entry.is_dir():
+                h.update(self._scan_dir([ e.path for e in found[entry.name]
+                                          if e.is_dir() ]).encode())
+        self.fingerprints[path] = h.hexdigest()
+        return self.fingerprints[path]
+
+    def scandir(self, path):
+        """
+        Returns the entries of a directory like os.scandir. Directories
+        which are not in the snapshot are scanned.
+
+        :param str path: path of the directory
+        """
+        try:
+            return self.children[path]
+        except KeyError:
+            return list(os.scandir(path))
+
+    def dir_layers(self, path):
+        """
+        Returns the paths in the sources a directory is merged from
+
+        :param str path: path of the directory as listed
+        """
+        return self.layers.get(path, [path])
+
+    def walk_dirs(self, path):
+        """
+        Yields the path of a directory and of all directories below it
+
+        :param str path: path of the directory
+        """
+        yield path
+        for entry in self.children.get(path, ()):
+            if entry.is_dir():
+                for p in self.walk_dirs(entry.path):
+                    yield p
+
+    def dirs(self):
+        """
+        Returns the paths of all directories in all sources, including
+        the sources
+        """
+        return self.roots + [ p for p, st in self.entries.items()
+                              if stat.S_ISDIR(st.st_mode) ]
+
+    def diff(self, other):
+        """
+        Returns an AppieSnapshotDiff of the sets of paths added, removed
+        and modified since another snapshot. A directory is modified if
+        an entry was added to or removed from it.
+
+        :param AppieSnapshot other: the snapshot of a previous run or None
+        """
+        old = other.entries if other is not None else {}
+        new = self.entries
+        return AppieSnapshotDiff( frozenset(new.keys() - old.keys()),
+                        frozenset(old.keys() - new.keys()),
+                        frozenset( p for p in new.keys() & old.keys()
+                                   if new[p] != old[p] ))
+
+    def __eq__(self, other):
+        return isinstance(other, AppieSnapshot) and \
+                self.roots == other.roots and self.entries == other.entries
+
+    __hash__ = None
+
+    def __getstate__(self):
+        # the listings are rebuilt from the entries if needed
+        return { 'roots': self.roots, 'entries': self.entries,
+                 'fingerprints': self.fingerprints }
+
+    def __setstate__(self, state):
+        self.roots = state['roots']
+        self.entries = state['entries']
+        self.fingerprints = state['fingerprints']
+        self.children = {}
+        self.layers = {}
+
+
+class AppieJSONWriter(object):
+    """
+    Writes a json object while its entries are being produced. The offset
+    and length of every file entry in the file is kept in an index so the
+    entries can be read back separately by AppieLazyDict.
+
+    The file is written to a temporary file which replaces the target
+    when closed.
+    """
+    def __init__(self, filepath, indexpath):
+        """
+        :param str filepath: path of the json file
+        :param str indexpath: path of the index file
+        """
+        self.filepath = filepath
+        self.indexpath = indexpath
+        self.f = open(filepath + '.tmp', 'wb')
+        self.offset = 0
+        self.index = {}         # relative path: (offset, length) or None for dirs
+        self.first = []         # stack of 'no entries yet' flags of open objects
+
+    def _write(self, s):
+        data = s.encode('utf8')
+        self.f.write(data)
+        self.offset += len(data)
+
+    def _key(self, key):
+        if not self.first[-1]:
+            self._write(', ')
+        self.first[-1] = False
+        self._write(json.dumps(key) + ': ')
+
+    def begin(self, key=None, relpath=None):
+        """
+        Begin an object, optionally as the value of key in the current one
+
+        :param str key: key in the current object
+        :param str relpath: relative path of the directory
+        """
+        if key is not None:
+            self._key(key)
+            self.index[relpath] = None
+        self._write('{')
+        self.first.append(True)
+
+    def entry(self, key, value, relpath=None):
+        """
+        Write a value in the current object, it is indexed if a relpath is
+        given
+
+        :param str key: key in the current object
+        :param value: the value to serialize
+        :param str relpath: relative path of the file
+        """
+        self._key(key)
+        start = self.offset
+        self._write(json.dumps(value))
+        if relpath is not None:
+            self.index[relpath] = (start, self.offset - start)
+
+    def end(self):
+        """
+        End the current object
+        """
+        self._write('}')
+        self.first.pop()
+
+    def close(self):
+        """
+        Close the file, replacing the target and save the index
+        """
+        self.f.close()
+        os.replace(self.filepath + '.tmp', self.filepath)
+        with open(self.indexpath, 'w') as f:
+            json.dump(self.index, f)
+
+
+class AppieLazyDict(object):
+    """
+    Read only dictionary of a directory in a json file written by
+    AppieJSONWriter. File entries are only read from the file when
+    accessed so the file is never loaded as a whole.
+    """
+    def __init__(self, f, index, relpath=''):
+        """
+        :param file f: the json file opened in binary mode
+        :param dict index: the index saved by AppieJSONWriter
+        :param str relpath: relative path of the directory
+        """
+        self.f = f
+        self.index = index
+        self.relpath = relpath
+
+    def get(self, name, default=None):
+        relpath = self.relpath + '/' + name if self.relpath else name
+        if relpath not in self.index:
+            return default
+        pos = self.index[relpath]
+        if pos is None:
+            return AppieLazyDict(self.f, self.index, relpath)
+        self.f.seek(pos[0])
+        return json.loads(self.f.read(pos[1]).decode('utf8'))
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return (self.relpath + '/' + name if self.relpath else name) in self.index
+
+
+class AppieBaseParser(object):
+    """
+    Base class of the file and directory parsers. A parser declares the
+    names it matches on through the match_suffixes, match_prefixes and
+    match_names attributes. These are compiled into an index when the
+    parser is added to Appie so the parser is found without calling every
+    parser's match method.
+
+    Parsers with a matching rule which can't be expressed this way can
+    override the match method instead. These are tested in order of
+    priority after the index.
+    """
+    match_suffixes = ()     # i.e. ('.md',)
+    match_prefixes = ()     # i.e. ('_',)
+    match_names = ()        # i.e. ('blog',)
+
+    def match(self, name):
+        """
+        Test if this parser matches for a name
+
+        :param str name: file or directory name
+        """
+        return name in self.match_names \
+            or name.endswith(tuple(self.match_suffixes)) \
+            or name.startswith(tuple(self.match_prefixes))
+
+    def is_indexed(self):
+        """
+        Returns true if the parser only matches on its declared suffixes,
+        prefixes and names
+        """
+        return type(self).match is AppieBaseParser.match
+
+
+class AppieDirParser(AppieBaseParser):
     """
     The default dir parser. Searches for parsers matching file or 
     directory parsers. If none found it recurses into subdirs and 
@@ -67,23 +821,43 @@ class AppieDirParser(object):
     * path: filepath ( in the build dir )
     * mtime: modification time
     """    
-    def match(self, name):
+    def is_modified(self, dirobj, prev_dict, parser=None):
         """
-        Test if this parser matches for a name
+        Check whether a file changed since the previous run. If a parser
+        is given the build cache is used to compare the content hash and
+        parser settings, otherwise the file's mtime is compared to the
+        previous run value
         
-        :param str name: file or directory name
-        """ 
-        return False
-        
-    def is_modified(self, dirobj, prev_dict):
-        """
-        Check file's mtime and compares it to the previous run value
-        
-        Returns true if newer
+        Returns true if modified
         """
         if not prev_dict or not prev_dict.get(dirobj.name):
             return True   # no previous data found so modified
-        return dirobj.stat().st_mtime > prev_dict.get(dirobj.name)[ 'mtime' ] 
+        if parser is None or Appie.cache is None:
+            return dirobj.stat().st_mtime > prev_dict.get(dirobj.name)[ 'mtime' ]
+        return Appie.cache.is_modified(dirobj.path, dirobj.stat(), parser)
+
+    def is_subtree_modified(self, diritem, prev):
+        """
+        Check whether anything in a directory or below changed since the
+        previous run by comparing the subtree fingerprints of the snapshots
+        of both runs. Directories containing a directory with its own
+        parser are always parsed, as such parsers may generate pages from
+        the whole directory.
+
+        :param diritem: os.DirEntry (or AppieDirEntry) of the directory
+        :param dict prev: the dictionary of the directory from the previous
+                          run
+        Returns true if modified
+        """
+        if not prev or Appie.snapshot is None or Appie.prev_snapshot is None:
+            return True
+        fingerprint = Appie.snapshot.fingerprints.get(diritem.path)
+        if fingerprint is None or \
+                fingerprint != Appie.prev_snapshot.fingerprints.get(diritem.path):
+            return True
+        return any( type(Appie.match_dir_parsers(os.path.basename(p)))
+                        is not AppieDirParser
+                    for p in Appie.snapshot.walk_dirs(diritem.path) )
 
     def parse_dir(self, path, dest_path, prev_dict=None):
         """
@@ -97,28 +871,173 @@ class AppieDirParser(object):
         """
         prev_dict = prev_dict or {}
         d = {}
-        for item in os.scandir(path):
-            # save the relative! path in the buildroot instead of the original
-            web_path = dest_path.split(config['target'])[1][1:]
-            if item.is_dir():
-                d[item.name] = self.parse_subdir( item, dest_path, prev_dict, web_path)
-            elif self.is_modified( item, prev_dict ):
-                # find a parser for this file
-                parser = Appie.match_file_parsers(item.name)
-                d[item.name] = parser.parse_file( item.path, item.name, dest_path )
-                d[item.name]['path'] = web_path
-                d[item.name]['mtime'] = item.stat().st_mtime
-                # copy file to dest if no content key
-                if not d[item.name].get( 'content' ) and parser.copyfile:
-                    logging.debug("Copy file {0} to the directory {1}"\
-                                    .format(path, dest_path))
-                    shutil.copy(item.path, dest_path)
+        for item in Appie.scandir(path):
+            d[item.name] = self.parse_entry( item, dest_path, prev_dict )
+        return d
+
+    async def parse_dir_async(self, path, dest_path, prev_dict=None):
+        """
+        Parse a directory like parse_dir in an async build. All entries of
+        the directory and its subdirectories are parsed concurrently. The
+        blocking calls (scandir, stat, reading, copying) are run in the I/O
+        thread pool, CPU bound parsers in the process pool if building with
+        multiple jobs.
+
+        :param str path: path of the directory
+        :param str dest_path: path of the destination directory
+        :param dict prev_dict: the dictionary belonging to this directory loaded
+                               from a previous run
+        Returns the dictionary with contents of the directory
+        """
+        prev_dict = prev_dict or {}
+        items = await Appie.run_io(lambda: list(Appie.scandir(path)))
+        results = await asyncio.gather(*( self.parse_entry_async( item,
+                                    dest_path, prev_dict ) for item in items ))
+        return { item.name: r for item, r in zip(items, results) }
+
+    async def parse_entry_async(self, item, dest_path, prev_dict):
+        """
+        Parse a single file or directory like parse_entry in an async build
+        """
+        web_path = dest_path.split(config['target'])[1][1:]
+        if item.is_dir():
+            return await self.parse_subdir_async( item, dest_path, prev_dict,
+                                                  web_path )
+        parser = Appie.match_file_parsers(item.name)
+        if await Appie.run_io( self.is_modified, item, prev_dict, parser ):
+            args = ( parser, item.path, item.name, dest_path, web_path,
+                     item.stat() )
+            if parser.cpu_bound and Appie.executor:
+                result = await Appie.run_cpu( parse_file_job, *args )
             else:
-                d[item.name] = prev_dict[item.name]
-                
+                result = await Appie.run_io( parse_file_job, *args )
+            return Appie.finish(result)
+        if Appie.profiler:
+            Appie.profiler.hit(item.path, parser)
+        d = prev_dict[item.name]
+        d['mtime'] = item.stat().st_mtime
         return d
 
+    async def parse_subdir_async(self, diritem, dest_path, prev_dict, web_path):
+        """
+        Parse a subdirectory like parse_subdir in an async build. Directory
+        parsers which only implement parse_dir are run in the I/O thread
+        pool.
+        """
+        prev = prev_dict.get( diritem.name )
+        if not self.is_subtree_modified( diritem, prev ):
+            return self.reuse_subdir( diritem, prev )
+        new_dest_path = os.path.join(dest_path, diritem.name)
+        await Appie.run_io( os.makedirs, new_dest_path, 0o777, True )
+        parser = Appie.match_dir_parsers(diritem.name)
+        if type(parser).parse_dir_async is AppieDirParser.parse_dir_async \
+                and type(parser).parse_dir is not AppieDirParser.parse_dir:
+            content = await Appie.run_io( parser.parse_dir, diritem.path,
+                                          new_dest_path, prev )
+        else:
+            content = await parser.parse_dir_async( diritem.path,
+                                                    new_dest_path, prev )
+        if content:
+            content['path'] = web_path
+            content['mtime'] = (await Appie.run_io( diritem.stat )).st_mtime
+        else:
+            try:
+                os.rmdir(new_dest_path)
+            except OSError:
+                pass
+        return content
+
+    def parse_entry(self, item, dest_path, prev_dict):
+        """
+        Parse a single file or directory
+
+        :param item: os.DirEntry (or AppieDirEntry) of the file or directory
+        :param str dest_path: path of the destination directory
+        :param dict prev_dict: the dictionary of the parent directory loaded
+                               from a previous run
+        Returns the dictionary of the file or directory
+        """
+        # save the relative! path in the buildroot instead of the original
+        web_path = dest_path.split(config['target'])[1][1:]
+        if item.is_dir():
+            return self.parse_subdir( item, dest_path, prev_dict, web_path)
+        # find a parser for this file
+        parser = Appie.match_file_parsers(item.name)
+        if self.is_modified( item, prev_dict, parser ):
+            # with multiple jobs this is a future resolved by Appie.parse
+            return Appie.submit( parse_file_job, parser, item.path, item.name,
+                                 dest_path, web_path, item.stat() )
+        if Appie.profiler:
+            Appie.profiler.hit(item.path, parser)
+        d = prev_dict[item.name]
+        # the content may be unchanged while the file was touched
+        d['mtime'] = item.stat().st_mtime
+        return d
+
+    def stream_dir(self, path, dest_path, prev_dict, writer, relpath=''):
+        """
+        Parse a directory like parse_dir but write the entries to writer
+        instead of returning the dictionary. All files of the directory
+        are parsed before recursing into its subdirectories so at most one
+        directory is kept in memory.
+
+        :param str path: path of the directory
+        :param str dest_path: path of the destination directory
+        :param dict prev_dict: the dictionary belonging to this directory
+                               from a previous run
+        :param AppieJSONWriter writer: the writer of the open directory
+        :param str relpath: relative path of the directory in the buildroot
+        Returns the number of entries written
+        """
+        prev_dict = prev_dict or {}
+        web_path = dest_path.split(config['target'])[1][1:]
+        entries = []
+        subdirs = []
+        for item in Appie.scandir(path):
+            if item.is_dir() and \
+                    type(Appie.match_dir_parsers(item.name)) is AppieDirParser:
+                subdirs.append(item)
+            else:
+                entries.append(( item.name,
+                                 self.parse_entry(item, dest_path, prev_dict) ))
+        count = len(entries) + len(subdirs)
+        # write (and free) the entries of this directory
+        while entries:
+            name, d = entries.pop(0)
+            if isinstance(d, concurrent.futures.Future):
+                d = Appie.finish(d.result())
+            else:
+                Appie.resolve(d)
+            writer.entry(name, d, relpath + '/' + name if relpath else name)
+        for item in subdirs:
+            subrelpath = relpath + '/' + item.name if relpath else item.name
+            new_dest_path = os.path.join(dest_path, item.name)
+            os.makedirs(new_dest_path, exist_ok=True)
+            writer.begin(item.name, subrelpath)
+            if self.stream_dir(item.path, new_dest_path,
+                               prev_dict.get(item.name), writer, subrelpath):
+                writer.entry('path', web_path)
+                writer.entry('mtime', item.stat().st_mtime)
+            else:
+                os.rmdir(new_dest_path)
+            writer.end()
+        return count
+
+    def reuse_subdir(self, diritem, prev):
+        """
+        Returns the dictionary of an unchanged directory from the previous
+        run, the records of its files are kept in the build state
+        """
+        for path in Appie.snapshot.dir_layers(diritem.path):
+            Appie.cache.keep(path)
+        if Appie.profiler:
+            Appie.profiler.hit(diritem.path, self)
+        prev['mtime'] = diritem.stat().st_mtime
+        return prev
+
     def parse_subdir(self, diritem, dest_path, prev_dict, web_path):
+        if not self.is_subtree_modified( diritem, prev_dict.get(diritem.name) ):
+            return self.reuse_subdir( diritem, prev_dict[diritem.name] )
         ret = {}
         new_dest_path = os.path.join(dest_path, diritem.name)
         # first create its dir
@@ -134,27 +1053,58 @@ class AppieDirParser(object):
             content['path'] = web_path
             content['mtime'] = diritem.stat().st_mtime
         else:
-            # if not we can remove the dir       TODO: does this hold?
-            # will error if new_dest_path not empty
-            os.remove(new_dest_path)
+            # if not we can remove the dir unless something else is in it
+            try:
+                os.rmdir(new_dest_path)
+            except OSError:
+                pass
         return content
 
 
-class AppieFileParser(object):
+class AppieFileParser(AppieBaseParser):
     """
     Appie default file parser. Loads the content of a file if
     it starts with _ (underscore).
     """
+    cpu_bound = False   # if true async builds parse in the process pool
     def __init__(self, *args, **kwargs):
         self.copyfile = True                # use the flag to tell the dirparser
                                             # to copy the file or not
 
-    def match(self, name):
+    def cache_key(self):
         """
-        Matches on files with the extension .textile
+        Returns a string identifying the parser and its settings. Files are
+        parsed again if this changes, so override it if your parser has
+        settings which influence the output.
         """
-        if name[0] == '_':
-            return True
+        key = "{0}.{1}".format(type(self).__module__, type(self).__name__)
+        if self.copyfile:
+            key += ":" + (config.get('publish') or 'copy')
+        return key
+
+    def outputs(self, filename, d):
+        """
+        Returns the list of filenames parse_file wrote to the destination
+        directory, a copy of the file itself is added by the dir parser.
+        Override this method if your parser writes files.
+
+        :param str filename: The name of the parsed file
+        :param dict d: The dictionary returned by parse_file
+        """
+        return []
+
+    def references(self, filename, d, dest_path):
+        """
+        Returns the links in the html generated for the file, as written in
+        the html. By default the links in the content key are returned.
+        Override this method if your parser writes html to files.
+
+        :param str filename: The name of the parsed file
+        :param dict d: The dictionary returned by parse_file
+        :param str dest_path: The destination directory
+        """
+        content = d.get('content')
+        return html_links(content) if isinstance(content, str) else []
 
     def parse_file(self, path, filename, dest_path):
         """
@@ -167,8 +1117,8 @@ class AppieFileParser(object):
         :param str path: Path to the file
         :param str filename: The name of the file
         """
-        if self.match(filename):                         # we only test again because the FileParser is always returned if
-            return { 'content': self.load_file(path) }   # no other parser matches but we only want to load if starting with _
+        if filename.startswith('_'):                     # the FileParser is always returned if no other parser
+            return { 'content': self.load_file(path) }   # matches but we only want to load if starting with _
         return {}
         
     def load_file(self, path, mode='r'):
@@ -188,13 +1138,8 @@ class AppieTextileParser(AppieFileParser):
     """
     Simple textile file to html parser
     """
-    def match(self, name):
-        """
-        Matches on files with the extension .textile
-        """
-        logging.debug('Matching AppieTextileParser to {0}'.format(name))
-        if name.endswith('.textile'):
-            return True
+    match_suffixes = ('.textile',)
+    cpu_bound = True
 
     def parse_file(self, path, filename, dest_path):
         """
@@ -211,16 +1156,79 @@ class AppieTextileParser(AppieFileParser):
         return { 'content': t }
 
 
+class AppieParserIndex(object):
+    """
+    Dispatch index of a list of parsers in order of priority. Parsers
+    declaring their matches are found through suffix, prefix and name
+    tables, parsers with their own match method are tested in order. The
+    parser with the highest priority wins, like testing every parser in
+    order would.
+    """
+    def __init__(self, parsers, default):
+        """
+        :param list parsers: parser instances, highest priority first
+        :param default: parser returned if no parser matches
+        """
+        self.default = default
+        self.names = {}         # name: priority
+        self.suffixes = {}      # suffix: priority
+        self.prefixes = {}      # prefix: priority
+        self.predicates = []    # (priority, parser)
+        self.parsers = list(parsers)
+        # add from low to high priority so the highest priority is kept
+        for prio in reversed(range(len(self.parsers))):
+            p = self.parsers[prio]
+            if not p.is_indexed():
+                self.predicates.insert(0, (prio, p))
+                continue
+            self.names.update((n, prio) for n in p.match_names)
+            self.suffixes.update((sfx, prio) for sfx in p.match_suffixes)
+            self.prefixes.update((pfx, prio) for pfx in p.match_prefixes)
+        self.suffix_lens = sorted({ len(sfx) for sfx in self.suffixes })
+        self.prefix_lens = sorted({ len(pfx) for pfx in self.prefixes })
+
+    def match(self, name):
+        """
+        Returns the parser matching name with the highest priority
+
+        :param str name: file or directory name
+        """
+        best = self.names.get(name, len(self.parsers))
+        for n in self.suffix_lens:
+            best = min(best, self.suffixes.get(name[-n:], best))
+        for n in self.prefix_lens:
+            best = min(best, self.prefixes.get(name[:n], best))
+        for prio, p in self.predicates:
+            if prio > best:
+                break
+            if p.match(name):
+                return p
+        if best < len(self.parsers):
+            return self.parsers[best]
+        return self.default
+
+
 class Appie(object):
     
     dir_parsers = []
     file_parsers = []
+    dir_index = AppieParserIndex([], AppieDirParser())
+    file_index = AppieParserIndex([], AppieFileParser())
+    executor = None     # process pool used when config['jobs'] > 1
+    io_executor = None  # thread pool of an async build
+    io_limit = None     # semaphore limiting the concurrent I/O of an async build
+    cache = None        # AppieBuildCache of the current build
+    snapshot = None     # AppieSnapshot of the sources while parsing
+    prev_snapshot = None    # AppieSnapshot of the previous run while parsing
+    profiler = None     # AppieProfiler of the last build if config['profile']
 
     def __init__(self, *args, **kwargs):
         # check if string and convert to list if so
         if isinstance(config["src"], str):
             config["src"] = [config["src"]]
         self._buildwd = os.path.abspath(config["target"])
+        self.tree = None    # dictionary of the last parse
+        self.changes = None # AppieSnapshotDiff of the last parse
 
     def add_directory_parser(self, inst):
         """
@@ -229,6 +1237,8 @@ class Appie(object):
         :param instance inst: parser instance
         """     
         Appie.dir_parsers.insert(0, inst)
+        Appie.dir_index = AppieParserIndex(Appie.dir_parsers,
+                                           Appie.dir_index.default)
 
     def add_file_parser(self, inst):
         """
@@ -237,6 +1247,8 @@ class Appie(object):
         :param instance inst: parser instance
         """     
         Appie.file_parsers.insert(0, inst)
+        Appie.file_index = AppieParserIndex(Appie.file_parsers,
+                                            Appie.file_index.default)
 
     @staticmethod
     def match_dir_parsers(dirname):
@@ -245,10 +1257,7 @@ class Appie(object):
         
         :params str dirname: directory name to match on
         """
-        for p in Appie.dir_parsers:
-            if p.match(dirname):
-                return p
-        return AppieDirParser() # default is self
+        return Appie.dir_index.match(dirname)  # default is AppieDirParser
 
     @staticmethod
     def match_file_parsers(filename):
@@ -257,10 +1266,85 @@ class Appie(object):
         
         :params str filename: filename to match on
         """
-        for p in Appie.file_parsers:
-            if p.match(filename):
-                return p
-        return AppieFileParser() # default is AppieFileParser
+        return Appie.file_index.match(filename)  # default is AppieFileParser
+
+    @staticmethod
+    def scandir(path):
+        """
+        Returns the entries of a directory, from the snapshot of the
+        sources while parsing
+
+        :param str path: path of the directory
+        """
+        if Appie.snapshot is not None:
+            return Appie.snapshot.scandir(path)
+        return os.scandir(path)
+
+    @staticmethod
+    def submit(fn, *args):
+        """
+        Run fn with the given arguments. When building with multiple jobs
+        it is submitted to the process pool and a future is returned which
+        is replaced by its result in Appie.resolve.
+
+        :param function fn: module level function to run, returning a tuple
+                            like parse_file_job does
+        """
+        if Appie.executor is None:
+            return Appie.finish(fn(*args))
+        return Appie.executor.submit(fn, *args)
+
+    @staticmethod
+    async def run_io(fn, *args):
+        """
+        Run a blocking function in the I/O thread pool of an async build,
+        at most config['io_limit'] at a time
+
+        :param function fn: the function to run
+        """
+        async with Appie.io_limit:
+            return await asyncio.get_event_loop().run_in_executor(
+                                                Appie.io_executor, fn, *args)
+
+    @staticmethod
+    async def run_cpu(fn, *args):
+        """
+        Run a module level function in the process pool of an async build
+
+        :param function fn: the function to run
+        """
+        async with Appie.io_limit:
+            return await asyncio.wrap_future(Appie.executor.submit(fn, *args))
+
+    @staticmethod
+    def finish(result):
+        """
+        Store the build cache record of a finished job and return the
+        dictionary of the file
+
+        :param tuple result: the dictionary, the (path, record) tuple and
+                             the profiler sample
+        """
+        d, (path, record), sample = result
+        if Appie.cache is not None:
+            Appie.cache.update(path, record)
+        if Appie.profiler and sample:
+            Appie.profiler.add(sample)
+        return d
+
+    @staticmethod
+    def resolve(d):
+        """
+        Replace all futures in a parsed dictionary by their results (in place)
+
+        :param dict d: dictionary returned by a directory parser
+        """
+        for k, v in d.items():
+            if isinstance(v, concurrent.futures.Future):
+                d[k] = Appie.finish(v.result())
+            elif isinstance(v, dict):
+                Appie.resolve(v)
+        return d
 
     def parse(self):
         """
@@ -268,21 +1352,558 @@ class Appie(object):
         """
         # create the buildroot
         prev = None     # previous all.json container
-        try:
-            os.makedirs(self._buildwd)
-        except FileExistsError:
-            # try to load previous run
+        # all.json can be written while parsing
+        stream = config.get('stream') and config.get('output') != 'shards'
+        os.makedirs(self._buildwd, exist_ok=True)
+        Appie.profiler = AppieProfiler() if config.get('profile') else None
+        with self.phase('scan'):
+            Appie.cache = AppieBuildCache( config.get('cache')
+                            or os.path.join(self._buildwd, '.appie_state') )
+            Appie.cache.load()
+            snapshot = AppieSnapshot.scan(config["src"])
+        self.changes = snapshot.diff(Appie.cache.tree)
+        settings = self.settings()
+        if snapshot == Appie.cache.tree and settings == Appie.cache.settings \
+                and self.output_exists():
+            logger.debug("Nothing changed since the previous run")
+            return
+        logger.debug("{0} added, {1} removed and {2} modified paths since "
+                     "the previous run".format(len(self.changes.added),
+                        len(self.changes.removed), len(self.changes.modified)))
+        # unchanged directories are reused as a whole if the parsers are
+        # the same
+        if settings == Appie.cache.settings:
+            Appie.prev_snapshot = Appie.cache.tree
+        Appie.cache.tree = snapshot
+        Appie.cache.settings = settings
+        # try to load previous run
+        with self.phase('load previous'):
             try:
-                prev = self.load_dict( os.path.join(self._buildwd, 'all.json' ) )
+                prev = stream and self.open_stream() or self.load_output()
             except FileNotFoundError:
                 prev = None
 
-        final = {}
+        jobs = config.get('jobs') or os.cpu_count()
+        if jobs > 1:
+            Appie.executor = concurrent.futures.ProcessPoolExecutor(jobs,
+                                initializer=_init_worker, initargs=(config,))
+        Appie.snapshot = snapshot
+        try:
+            if stream:
+                self.tree = None
+                with self.phase('parse'):
+                    self.stream_output(snapshot.root, prev)
+            else:
+                # the overlay of all sources is parsed at once, files are
+                # submitted to the pool first and collected by resolve
+                with self.phase('parse'):
+                    if config.get('async'):
+                        final = asyncio.run(self.parse_async(prev))
+                    else:
+                        final = AppieDirParser().parse_dir( snapshot.root,
+                                                    config["target"], prev )
+                    self.resolve(final)
+                self.tree = final
+                with self.phase('save output'):
+                    self.save_output(final)
+        finally:
+            Appie.snapshot = Appie.prev_snapshot = None
+            if Appie.executor:
+                Appie.executor.shutdown()
+                Appie.executor = None
+            if isinstance(prev, AppieLazyDict):
+                prev.f.close()
+        with self.phase('save state'):
+            Appie.cache.prune()
+            self.remove_outputs()
+            Appie.cache.save()
+        if config.get('compress'):
+            with self.phase('compress'):
+                self.compress_output()
+                Appie.cache.save(prune=False)
+
+    async def parse_async(self, prev):
+        """
+        Parse the overlay of the source directories concurrently, returns
+        its dictionary
+
+        :param dict prev: the dictionary of the previous run
+        """
+        limit = config.get('io_limit') or 32
+        Appie.io_limit = asyncio.Semaphore(limit)
+        with concurrent.futures.ThreadPoolExecutor(limit) as pool:
+            Appie.io_executor = pool
+            try:
+                return await AppieDirParser().parse_dir_async(
+                            Appie.snapshot.root, config["target"], prev )
+            finally:
+                Appie.io_executor = None
+
+    def phase(self, name):
+        """
+        Returns a context manager measuring a phase of the build when
+        profiling
+
+        :param str name: name of the phase
+        """
+        if Appie.profiler:
+            return Appie.profiler.phase(name)
+        return contextlib.nullcontext()
+
+    def settings(self):
+        """
+        Returns the settings which influence the output of a build
+        """
+        return ( config.get('output'), config.get('shard_depth'),
+                 config.get('compress'), config.get('url'),
+                 [ p.cache_key() for p in Appie.file_parsers ],
+                 [ "{0}.{1}".format(type(p).__module__, type(p).__name__)
+                        for p in Appie.dir_parsers ] )
+
+    def output_exists(self):
+        """
+        Returns true if the output of a previous build exists
+        """
+        name = os.path.join('.appie_shards', 'manifest.json') \
+                if config.get('output') == 'shards' else 'all.json'
+        return os.path.isfile(os.path.join(config["target"], name))
+
+    def open_stream(self):
+        """
+        Returns an AppieLazyDict of the all.json written by stream_output
+        or None if there is no index
+        """
+        try:
+            with open(os.path.join(config["target"], '.appie_index.json')) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return AppieLazyDict(open(os.path.join(config["target"], 'all.json'), 'rb'), index)
+
+    def stream_output(self, src, prev):
+        """
+        Parse a source directory writing all.json while parsing
+
+        :param str src: the root of the overlay of the source directories
+        :param prev: the dictionary (or AppieLazyDict) of the previous run
+        """
+        writer = AppieJSONWriter(os.path.join(config["target"], 'all.json'),
+                        os.path.join(config["target"], '.appie_index.json'))
+        writer.begin()
+        AppieDirParser().stream_dir( src, config["target"], prev, writer )
+        writer.end()
+        writer.close()
+
+    def update(self, paths, moves=(), cancelled=None):
+        """
+        Parse only the given changed paths, patch the results into the
+        dictionary of the last parse (or the saved output) and save it
+        once. Does a full parse if nothing was parsed before. The outputs
+        of removed files are removed from the buildroot.
+
+        :param iterable paths: changed (or removed) files or directories
+                               in the source directories
+        :param iterable moves: (old path, new path) tuples of renamed files
+                               or directories. Their outputs are moved if
+                               possible, otherwise both paths are parsed.
+        :param cancelled: optional callable returning true if the update is
+                          superseded by newer changes. It is checked after
+                          every parsed path, if true the update stops
+                          without saving.
+        Returns the paths which were not parsed because the update was
+        cancelled
+        """
+        if self.tree is None:
+            try:
+                self.tree = self.load_output()
+            except FileNotFoundError:
+                self.parse()
+                return []
+        paths = list(paths)
+        for old, new in moves:
+            if not self._move(old, new):
+                paths.extend((old, new))
+        for i, path in enumerate(paths):
+            if i and cancelled and cancelled():
+                logger.debug("Update superseded, {0} path(s) left"
+                             .format(len(paths) - i))
+                return paths[i:]
+            rel = self._source_relpath(path)
+            if rel is None:
+                logger.warning("{0} is not in a source directory".format(path))
+            elif rel == os.curdir:
+                self.parse()
+                return []
+            else:
+                self._update_relpath(rel)
+                if not os.path.exists(path):
+                    self._report_removed(path)
+        written = self.save_output(self.tree)
+        if Appie.cache is not None:
+            self.remove_outputs()
+            if config.get('compress'):
+                # only what this update wrote or removed
+                self.compress_output(written + sorted(Appie.cache.touched))
+            Appie.cache.touched.clear()
+            # the snapshot is outdated, the next parse can't be skipped
+            Appie.cache.tree = None
+            Appie.cache.save(prune=False)
+        return []
+
+    def _move(self, old, new):
+        """
+        Move the entry and outputs of a renamed file or directory instead
+        of parsing it again. Returns false if it can't be moved, i.e. if
+        its outputs are named after the file (image renditions) or its
+        links would resolve differently.
+
+        :param str old: the previous path of the file or directory
+        :param str new: the new path of the file or directory
+        """
+        old_rel, new_rel = self._source_relpath(old), self._source_relpath(new)
+        if Appie.cache is None or len(config["src"]) > 1 or None in \
+                (old_rel, new_rel) or os.path.exists(old) or not os.path.exists(new):
+            return False    # overlays of multiple sources are parsed
+        old_parts, new_parts = old_rel.split(os.sep), new_rel.split(os.sep)
+        # directories with their own parser are parsed as a whole
+        if any( type(Appie.match_dir_parsers(name)) is not AppieDirParser
+                for name in old_parts[:-1] + new_parts[:-1] ):
+            return False
+        def find(parts):
+            node = self.tree
+            for name in parts:
+                node = node.get(name)
+                if not isinstance(node, dict):
+                    return None
+            return node
+        old_node, new_node = find(old_parts[:-1]), find(new_parts[:-1])
+        entry = old_node and old_node.get(old_parts[-1])
+        if new_node is None or not isinstance(entry, dict):
+            return False
+        old_web, new_web = '/'.join(old_parts), '/'.join(new_parts)
+        if os.path.isdir(new):
+            if type(Appie.match_dir_parsers(old_parts[-1])) is not AppieDirParser \
+                or type(Appie.match_dir_parsers(new_parts[-1])) is not AppieDirParser \
+                or not self._movable_dir(entry):
+                return False
+            prefix = old.rstrip(os.sep) + os.sep
+            records = { p: r for p, r in Appie.cache.records.items()
+                        if p.startswith(prefix) }
+            # links would resolve differently if they leave the directory
+            if any( not ref.startswith(old_web + '/')
+                    for r in records.values() for ref in r.refs ):
+                return False
+            def rebase(p, a, b):
+                return b + p[len(a):] if p == a or p.startswith(a + '/') else p
+            for p, r in records.items():
+                Appie.cache.touched.update(r.outputs)
+                del Appie.cache.records[p]
+                Appie.cache.update(os.path.join(new, p[len(prefix):]),
+                    r._replace(outputs=[ rebase(o, old_web, new_web) for o in r.outputs ],
+                               refs=[ rebase(o, old_web, new_web) for o in r.refs ]))
+        else:
+            rec = Appie.cache.records.get(old)
+            parser = Appie.match_file_parsers(new_parts[-1])
+            if rec is None or rec.parser != parser.cache_key() \
+                    or list(rec.outputs) not in ([], [old_web]) \
+                    or (rec.refs and old_parts[:-1] != new_parts[:-1]):
+                return False
+            Appie.cache.touched.update(rec.outputs)
+            del Appie.cache.records[old]
+            Appie.cache.update(new, rec._replace(
+                                outputs=[new_web] if rec.outputs else []))
+        # move the outputs
+        old_out = os.path.join(self._buildwd, *old_parts)
+        new_out = os.path.join(self._buildwd, *new_parts)
+        if os.path.exists(old_out):
+            os.makedirs(os.path.dirname(new_out), exist_ok=True)
+            os.replace(old_out, new_out)
+        # move the entry and fix the paths in it
+        del old_node[old_parts[-1]]
+        new_node[new_parts[-1]] = entry
+        entry['mtime'] = os.stat(new).st_mtime
+        self._set_paths(entry, '/'.join(new_parts[:-1]), new_web)
+        for node, parts in ((old_node, old_parts), (new_node, new_parts)):
+            if node is not self.tree:
+                node['mtime'] = os.stat(os.path.dirname(
+                                    os.path.join(config["src"][0], *parts))).st_mtime
+        logger.debug("Moved {0} to {1}".format(old, new))
+        return True
+
+    def _movable_dir(self, node):
+        """
+        Returns false if a directory contains directories with their own
+        parser, these are parsed again on a move
+        """
+        for k, v in node.items():
+            if isinstance(v, dict) and 'path' in v and not 'content' in v:
+                if type(Appie.match_dir_parsers(k)) is not AppieDirParser \
+                        or not self._movable_dir(v):
+                    return False
+        return True
+
+    def _set_paths(self, entry, web_path, entry_web_path):
+        """
+        Set the path key of an entry and, for a directory, of everything in
+        it after it was moved
+        """
+        entry['path'] = web_path
+        for k, v in entry.items():
+            if isinstance(v, dict) and 'path' in v:
+                self._set_paths(v, entry_web_path, entry_web_path + '/' + k)
+
+    def _report_removed(self, path):
+        """
+        Drop the build state of a removed file or directory and warn about
+        the files linking to it. Outputs still produced by another file
+        (i.e. the same file in another source directory) are not gone.
+        """
+        if Appie.cache is None:
+            return
+        removed = Appie.cache.remove(path)
+        records = Appie.cache.records
+        gone = { o for r in removed.values() for o in r.outputs } - \
+               { o for r in records.values() for o in r.outputs }
+        for dep in sorted( p for p, r in records.items()
+                           if gone.intersection(r.refs) or path in r.deps ):
+            logger.warning("{0} links to {1} which was removed"
+                           .format(dep, path))
+
+    def remove_outputs(self):
+        """
+        Remove the stale outputs of removed (or changed) files from the
+        buildroot and the directories left empty
+        """
+        dirs = set()
+        for out in Appie.cache.stale_outputs():
+            if out.split('/')[0] == '.appie_shards':
+                continue    # never remove the shards
+            filepath = os.path.join(self._buildwd, *out.split('/'))
+            logger.debug("Removing stale output {0}".format(filepath))
+            try:
+                os.remove(filepath)
+            except (FileNotFoundError, IsADirectoryError):
+                continue
+            if Appie.cache.sidecars.pop(out, None):
+                remove_sidecars(filepath)
+            dirs.add(os.path.dirname(filepath))
+        Appie.cache.stale.clear()
+        # deepest first so parents can be removed as well
+        for d in sorted(dirs, key=len, reverse=True):
+            while d.startswith(self._buildwd + os.sep):
+                try:
+                    os.rmdir(d)
+                except OSError:
+                    break   # not empty
+                d = os.path.dirname(d)
+
+    def compress_output(self, paths=None):
+        """
+        Write the gzip (and brotli) sidecars of the text files in the
+        buildroot which changed, see appie.compress.compress_output
+
+        :param list paths: relative paths in the buildroot to check, by
+                           default all files are
+        """
+        count = compress_output(self._buildwd, Appie.cache.sidecars,
+                                config.get('compress_jobs'), paths)
+        logger.debug("Compressed {0} files".format(count))
+
+    def broken_links(self):
+        """
+        Returns a sorted list of (path, link) tuples of the links in the
+        parsed files which don't point to a file in the buildroot. Uses the
+        build state of the last parse so nothing is parsed again.
+        """
+        cache = Appie.cache
+        if cache is None:
+            cache = AppieBuildCache( config.get('cache')
+                            or os.path.join(self._buildwd, '.appie_state') )
+            cache.load()
+        return cache.broken_links(config["target"], config["src"])
+
+    def _source_relpath(self, path):
+        """
+        Returns the path relative to the source directory containing it
+        """
         for src in config["src"]:
-            d = AppieDirParser().parse_dir( src, config["target"], prev )
-            final = dict(mergedicts(final, d))
-        #return final
-        self.save_dict(final, os.path.join(config["target"], 'all.json'))
+            rel = os.path.relpath(path, src)
+            if not rel.startswith(os.pardir):
+                return rel
+
+    def _update_relpath(self, rel):
+        """
+        Parse a single path relative to the sources into self.tree
+        """
+        parts = rel.split(os.sep)
+        # directories with their own parser are parsed as a whole
+        for i, name in enumerate(parts[:-1]):
+            if type(Appie.match_dir_parsers(name)) is not AppieDirParser:
+                parts = parts[:i+1]
+                break
+        # find the parent's dictionary, new directories are parsed as a whole
+        node = self.tree
+        for i, name in enumerate(parts[:-1]):
+            if name not in node:
+                parts = parts[:i+1]
+                break
+            node = node[name]
+        name = parts[-1]
+        if node is not self.tree:
+            # adding or removing entries changes the mtime of the parent
+            for src in reversed(config["src"]):
+                if os.path.isdir(os.path.join(src, *parts[:-1])):
+                    node['mtime'] = os.stat(os.path.join(src, *parts[:-1])).st_mtime
+                    break
+        entries = [ AppieDirEntry(os.path.join(src, *parts))
+                    for src in config["src"]
+                    if os.path.exists(os.path.join(src, *parts)) ]
+        if not entries:
+            node.pop(name, None)    # removed from all sources
+            return
+        if Appie.cache is not None:
+            # shadowed files are parsed again once the override is removed
+            for e in entries[:-1]:
+                if not e.is_dir():
+                    Appie.cache.remove(e.path)
+        dest_path = os.path.join(config["target"], *parts[:-1])
+        os.makedirs(dest_path, exist_ok=True)
+        # like a full parse: directories merge, otherwise the last source wins
+        layers = [ e.path for e in entries if e.is_dir() ]
+        if entries[-1].is_dir() and len(layers) > 1:
+            Appie.snapshot = AppieSnapshot.scan(layers)
+        try:
+            node[name] = AppieDirParser().parse_entry( entries[-1], dest_path, node )
+        finally:
+            Appie.snapshot = None
+
+    def save_output(self, d):
+        """
+        Save the dictionary of the site as all.json or as shards depending
+        on config['output']. Returns the relative paths of the files
+        written or removed.
+
+        :param dict d: the dictionary to save
+        """
+        if config.get('output') == 'shards':
+            return self.save_shards(d, config["target"])
+        else:
+            self.save_dict(d, os.path.join(config["target"], 'all.json'))
+            # the index of a streamed all.json is no longer valid
+            try:
+                os.remove(os.path.join(config["target"], '.appie_index.json'))
+            except FileNotFoundError:
+                pass
+            return ['all.json']
+
+    def load_output(self):
+        """
+        Load the dictionary of the site saved by save_output
+        """
+        if config.get('output') == 'shards':
+            return self.load_shards(config["target"])
+        return self.load_dict(os.path.join(config["target"], 'all.json'))
+
+    def save_shards(self, d, target):
+        """
+        Save the dictionary as a json shard per directory in
+        target/.appie_shards, out of the way of the files of the site.
+        Directories deeper than config['shard_depth'] are included in the
+        shard of their parent. In a shard a subdirectory is replaced by a
+        dictionary with its path, mtime and the shard key pointing to its
+        shard file.
+
+        The .appie_shards/manifest.json file maps the path of every sharded
+        directory to its shard file (relative to the buildroot) and the md5
+        of the shard. Only shards whose md5 changed are written. Returns
+        the relative paths of the files written or removed.
+
+        :param dict d: the dictionary to save
+        :param string target: the buildroot
+        """
+        try:
+            prev = self.load_dict(os.path.join(target, '.appie_shards',
+                                               'manifest.json'))
+        except (FileNotFoundError, ValueError):
+            prev = {}
+        manifest = {}
+        written = []
+        self._save_shard(d, '', target, prev, manifest, written)
+        # remove shards of removed directories
+        for relpath, shard in prev.items():
+            if relpath not in manifest:
+                written.append(shard['file'])
+                filepath = os.path.join(target, *shard['file'].split('/'))
+                try:
+                    os.remove(filepath)
+                    os.removedirs(os.path.dirname(filepath))
+                except OSError:
+                    pass
+        self.save_dict(manifest, os.path.join(target, '.appie_shards',
+                                              'manifest.json'))
+        return written + ['.appie_shards/manifest.json']
+
+    def _save_shard(self, d, relpath, target, prev, manifest, written):
+        """
+        Save the shard of the directory at relpath and its subdirectories,
+        returns the filename of the shard. The filenames of the shards
+        written are appended to written.
+        """
+        depth = len(relpath.split('/')) if relpath else 0
+        max_depth = config.get('shard_depth')
+        shard = {}
+        for k, v in d.items():
+            childpath = relpath + '/' + k if relpath else k
+            if (max_depth is None or depth < max_depth) \
+                    and self._is_dir_dict(v, childpath):
+                shard[k] = { 'path': v.get('path'),
+                             'mtime': v.get('mtime'),
+                             'shard': self._save_shard(v, childpath, target,
+                                                prev, manifest, written) }
+            else:
+                shard[k] = v
+        data = json.dumps(shard)
+        filename = '/'.join(['.appie_shards'] + relpath.split('/')
+                            + ['index.json']) \
+                        if relpath else '.appie_shards/index.json'
+        manifest[relpath] = { 'file': filename,
+                              'md5': hashlib.md5(data.encode('utf8')).hexdigest() }
+        filepath = os.path.join(target, *filename.split('/'))
+        if prev.get(relpath) != manifest[relpath] or not os.path.exists(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with open(filepath + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(filepath + '.tmp', filepath)
+            written.append(filename)
+        return filename
+
+    def _is_dir_dict(self, d, relpath):
+        """
+        Returns true if d is the dictionary of a directory, i.e. it holds
+        an entry whose path is relpath. Decided from the dictionary only
+        so the layout does not depend on previous builds.
+        """
+        return isinstance(d, dict) and any( isinstance(v, dict) and
+                                v.get('path') == relpath for v in d.values() )
+
+    def load_shards(self, target):
+        """
+        Load the complete dictionary from the shards saved by save_shards
+
+        :param string target: the buildroot
+        """
+        manifest = self.load_dict(os.path.join(target, '.appie_shards',
+                                                'manifest.json'))
+        return self._load_shard(manifest['']['file'], target)
+
+    def _load_shard(self, filename, target):
+        d = self.load_dict(os.path.join(target, *filename.split('/')))
+        for k, v in d.items():
+            if isinstance(v, dict) and set(v) == {'path', 'mtime', 'shard'}:
+                d[k] = self._load_shard(v['shard'], target)
+                d[k]['path'] = v['path']
+                d[k]['mtime'] = v['mtime']
+        return d
 
     def save_dict(self, d, filepath):
         """
@@ -291,8 +1912,10 @@ class Appie(object):
         :param dict d: the dictionary to save
         :param string filepath: string containing the full target filepath
         """
-        with open(filepath, 'w') as f:
+        # replace the file at once so it is never served half written
+        with open(filepath + '.tmp', 'w') as f:
             json.dump(d, f)
+        os.replace(filepath + '.tmp', filepath)
 
     def load_dict(self, filepath):
         """
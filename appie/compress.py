@@ -0,0 +1,177 @@
+# Precompressed sidecars of the build output
+#
+# Copyright (c) 2015, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License v3 for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+import os
+import stat
+import gzip
+import hashlib
+import logging
+import concurrent.futures
+
+# brotli is optional, without it only .gz sidecars are written
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# files which are worth compressing
+COMPRESS_SUFFIXES = ('.html', '.htm', '.json', '.xml', '.css', '.js', '.svg',
+                     '.txt', '.csv', '.md')
+# smaller files hardly get smaller
+MIN_SIZE = 256
+# all sidecars appie may have written, see sidecar_suffixes
+SIDECAR_SUFFIXES = ('.gz', '.br')
+
+
+def sidecar_suffixes():
+    """
+    Returns the suffixes of the sidecars written: .gz and .br if the
+    brotli module is available
+    """
+    return SIDECAR_SUFFIXES if brotli else SIDECAR_SUFFIXES[:1]
+
+
+def _write(path, data):
+    # write next to it and rename so a server never reads a partial file
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def compress_file(path, md5=None):
+    """
+    Write the sidecars of a file unless its content still has the given
+    md5 and its sidecars exist. The sidecars get the mtime of the file so
+    a server can tell whether they are up to date. Returns the md5 and
+    stat result of the file and whether it was compressed.
+
+    :param str path: path of the file
+    :param str md5: md5 of the content of the file the sidecars were
+                    written for by the previous run
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+    digest = hashlib.md5(data).hexdigest()
+    suffixes = sidecar_suffixes()
+    if digest == md5:
+        try:
+            for suffix in suffixes:
+                os.utime(path + suffix, ns=(st.st_atime_ns, st.st_mtime_ns))
+            return digest, st, False
+        except FileNotFoundError:
+            pass
+    _write(path + '.gz', gzip.compress(data, 9, mtime=0))
+    if brotli:
+        _write(path + '.br', brotli.compress(data))
+    for suffix in suffixes:
+        os.utime(path + suffix, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return digest, st, True
+
+
+def remove_sidecars(path):
+    """
+    Remove the sidecars of a file
+
+    :param str path: path of the file
+    """
+    for suffix in SIDECAR_SUFFIXES:
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def compressible(name, st):
+    """
+    Returns true if a file in the buildroot should get sidecars
+
+    :param str name: name of the file
+    :param os.stat_result st: stat result of the file
+    """
+    return not name.startswith('.') and name.endswith(COMPRESS_SUFFIXES) \
+            and st.st_size >= MIN_SIZE
+
+
+def compress_output(target, state, jobs=None, paths=None):
+    """
+    Write gzip (and brotli) sidecars of the text files in the buildroot,
+    like all.json.gz next to all.json, using a pool of threads. Only
+    files whose content changed since the previous run are compressed.
+    Sidecars of files which are gone are removed. Returns the number of
+    files compressed.
+
+    :param str target: the buildroot
+    :param dict state: the relative path of every file with sidecars by
+                       the previous run and its (mtime_ns, size, md5,
+                       suffixes), updated in place
+    :param int jobs: number of threads, defaults to the number of cores
+    :param iterable paths: relative paths of the files written or removed,
+                           only these are checked instead of walking the
+                           whole buildroot
+    """
+    suffixes = sidecar_suffixes()
+    found = set()
+    todo = []
+    if paths is None:
+        files = []
+        for path, dirs, filenames in os.walk(target):
+            # skip .appie_jinja and the like, but not the shards for clients
+            dirs[:] = [ d for d in dirs if not d.startswith('.')
+                        or d == '.appie_shards' ]
+            files.extend(os.path.join(path, name) for name in filenames)
+        gone = lambda rel: rel not in found
+    else:
+        paths = set(paths)
+        files = [ os.path.join(target, *rel.split('/')) for rel in paths ]
+        gone = lambda rel: rel in paths and rel not in found
+    for filepath in files:
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(st.st_mode) or \
+                not compressible(os.path.basename(filepath), st):
+            continue
+        rel = os.path.relpath(filepath, target).replace(os.sep, '/')
+        found.add(rel)
+        prev = state.get(rel)
+        if prev and prev[3] == suffixes and \
+                prev[:2] == (st.st_mtime_ns, st.st_size):
+            continue
+        todo.append((rel, filepath, prev[2] if prev and
+                                      prev[3] == suffixes else None))
+    for rel in [ r for r in state if gone(r) ]:
+        logger.debug("Removing the sidecars of {0}".format(rel))
+        remove_sidecars(os.path.join(target, *rel.split('/')))
+        del state[rel]
+    count = 0
+    # zlib and brotli release the GIL while compressing
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        futures = { pool.submit(compress_file, filepath, md5): rel
+                    for rel, filepath, md5 in todo }
+        for future in concurrent.futures.as_completed(futures):
+            rel = futures[future]
+            try:
+                md5, st, compressed = future.result()
+            except FileNotFoundError:
+                state.pop(rel, None)    # removed meanwhile
+                continue
+            state[rel] = (st.st_mtime_ns, st.st_size, md5, suffixes)
+            count += compressed
+    return count
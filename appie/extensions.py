@@ -19,10 +19,16 @@ import appie
 import markdown
 import logging
 import os
-import shutil
 import filecmp
+import hashlib
+import json
+import re
+import time
+import contextlib
+import threading
 from html.parser import HTMLParser
-from jinja2 import Template
+import jinja2
+import jinja2.meta
 from PIL import Image
 
 # for pre 3.5 python versions 
@@ -34,6 +40,162 @@ except AttributeError:
 
 logger = logging.getLogger(__name__)
 
+MARKDOWN_EXTENSIONS = (
+    'markdown.extensions.tables',
+    'markdown.extensions.meta',
+    'markdown.extensions.codehilite',
+    'markdown.extensions.toc'
+)
+# image formats of the renditions: PIL format, file extension and mimetype
+IMAGE_FORMATS = {
+    'jpg': ('JPEG', '.jpg', 'image/jpeg'),
+    'webp': ('WEBP', '.webp', 'image/webp')
+}
+# default templates of the blog listing pages and feed
+BLOG_TEMPLATES = {
+    'index.jinja2': """<!DOCTYPE html>
+<html>
+  <head><title>Blog{% if page > 1 %} - page {{ page }}{% endif %}</title></head>
+  <body>
+    <ul>
+    {% for post in posts %}
+      <li><a href="{{ post.file|e }}">{{ post.title|e }}</a> {{ post.date|e }}
+        <p>{{ post.summary|e }}</p></li>
+    {% endfor %}
+    </ul>
+    {% if newer %}<a href="{{ newer }}">Newer posts</a>{% endif %}
+    {% if older %}<a href="{{ older }}">Older posts</a>{% endif %}
+  </body>
+</html>
+""",
+    'tag.jinja2': """<!DOCTYPE html>
+<html>
+  <head><title>Posts tagged {{ tag|e }}</title></head>
+  <body>
+    <ul>
+    {% for post in posts %}
+      <li><a href="../{{ post.file|e }}">{{ post.title|e }}</a> {{ post.date|e }}</li>
+    {% endfor %}
+    </ul>
+  </body>
+</html>
+""",
+    'atom.jinja2': """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>{{ title|e }}</title>
+  <id>{{ url|e }}</id>
+  <link href="{{ url|e }}"/>
+  <updated>{{ updated }}</updated>
+{% for post in posts %}
+  <entry>
+    <title>{{ post.title|e }}</title>
+    <id>{{ url|e }}{{ post.file|e }}</id>
+    <link href="{{ url|e }}{{ post.file|e }}"/>
+    <updated>{{ post.updated }}</updated>
+    <summary>{{ post.summary|e }}</summary>
+{% for tag in post.tags %}
+    <category term="{{ tag|e }}"/>
+{% endfor %}
+  </entry>
+{% endfor %}
+</feed>
+"""
+}
+_markdown = threading.local()   # converters of this process and thread
+_jinja_envs = {}                # (template dir, cache dir): jinja2.Environment
+_templates = {}                 # template path: (mtime, size, md5, references)
+
+
+def get_markdown(extensions=MARKDOWN_EXTENSIONS):
+    """
+    Returns a reset markdown.Markdown converter with the given extensions.
+    Converters are created once per process and thread and reused for
+    every document, so extensions are only loaded once.
+
+    :param tuple extensions: names of the markdown extensions
+    """
+    converters = _markdown.__dict__.setdefault('converters', {})
+    md = converters.get(extensions)
+    if md is None:
+        md = converters[extensions] = markdown.Markdown(
+                                            extensions=list(extensions))
+    return md.reset()
+
+
+def get_jinja_env(path, cache_dir=None, defaults=None):
+    """
+    Returns the jinja2.Environment loading templates from path. The
+    environment is created once per process and keeps the compiled
+    templates in memory. If cache_dir is given the compiled templates are
+    cached there as well so templates are only compiled again if they
+    changed.
+
+    :param str path: the directory containing the templates
+    :param str cache_dir: the directory to cache compiled templates in
+    :param dict defaults: sources of templates by name used if the
+                          template is not found in path
+    """
+    env = _jinja_envs.get((path, cache_dir))
+    if env is None:
+        bcc = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            bcc = jinja2.FileSystemBytecodeCache(cache_dir)
+        loader = jinja2.FileSystemLoader(path)
+        if defaults:
+            loader = jinja2.ChoiceLoader([loader, jinja2.DictLoader(defaults)])
+        env = _jinja_envs[(path, cache_dir)] = jinja2.Environment(
+                loader=loader, bytecode_cache=bcc, auto_reload=True)
+    return env
+
+
+def template_fingerprint(env, name, seen=None, files=None):
+    """
+    Returns a hash of the source of a template and all templates it
+    extends, includes or imports. Templates are only read again if their
+    mtime or size changed.
+
+    :param jinja2.Environment env: the environment of the template
+    :param str name: the name of the template
+    :param list files: if given the paths of the template files are
+                       appended to it
+    """
+    seen = seen if seen is not None else set()
+    seen.add(name)
+    cached = None
+    for loader in getattr(env.loader, 'loaders', [env.loader]):
+        if isinstance(loader, jinja2.DictLoader):
+            if name in loader.mapping:
+                source = loader.mapping[name]
+                cached = (None, None, hashlib.md5(source.encode('utf8')).hexdigest(),
+                          [ r for r in jinja2.meta.find_referenced_templates(
+                                                    env.parse(source)) if r ])
+                break
+            continue
+        filename = next(( os.path.join(p, name) for p in loader.searchpath
+                          if os.path.isfile(os.path.join(p, name)) ), None)
+        if filename is None:
+            continue
+        if files is not None:
+            files.append(filename)
+        st = os.stat(filename)
+        cached = _templates.get(filename)
+        if not cached or cached[:2] != (st.st_mtime, st.st_size):
+            source = loader.get_source(env, name)[0]
+            refs = [ r for r in jinja2.meta.find_referenced_templates(
+                                                    env.parse(source)) if r ]
+            cached = _templates[filename] = (st.st_mtime, st.st_size,
+                        hashlib.md5(source.encode('utf8')).hexdigest(), refs)
+        break
+    if cached is None:
+        return 'missing'
+    fingerprint = hashlib.md5(cached[2].encode())
+    for ref in cached[3]:
+        if ref not in seen:
+            fingerprint.update(template_fingerprint(env, ref, seen,
+                                                    files).encode())
+    return fingerprint.hexdigest()
+
 
 class AbstractHTMLParser(HTMLParser):
     """
@@ -72,9 +234,12 @@ class AppieMarkdownParser(appie.AppieFileParser):
     """
     Simple markdown file to html parser
     """
-    def match(self, name):
-        if name.endswith(".md"):
-            return True
+    match_suffixes = ('.md',)
+    markdown_extensions = MARKDOWN_EXTENSIONS
+    cpu_bound = True
+
+    def cache_key(self):
+        return "{0}:{1}".format(super().cache_key(), self.markdown_extensions)
 
     def parse_file(self, path, filename, dest_path):
         """
@@ -88,116 +253,178 @@ class AppieMarkdownParser(appie.AppieFileParser):
         """
         Read the file and return the content parsed through markdown
         """
-        md = markdown.Markdown(
-                    extensions=[
-                        'markdown.extensions.tables',
-                        'markdown.extensions.meta',
-                        'markdown.extensions.codehilite',
-                        'markdown.extensions.toc'
-                        ]
-                    )
+        md = get_markdown(self.markdown_extensions)
         # generate the html from the .md file
         html = md.convert(self.load_file(file))
         meta = md.Meta
         return meta, html
 
 
-class AppiePNGParser(appie.AppieFileParser):
+class AppieImageParser(appie.AppieFileParser):
     """
-    PNG parser converting PNGs to JPG and a JPG thumb
-
-    :note: to not parse PNG images and just copy them to the build root
-           use a captital extension (.PNG). The parsers are case sensitive!
+    Base class of the image parsers. Decodes an image once and saves all
+    renditions, each one resized from the previous (larger) one. JPG
+    images are downscaled while decoding if possible. A rendition which
+    has the size and format of the original is a copy of the original,
+    if all renditions are the image is not decoded at all.
+
+    The renditions are set through the 'renditions' setting, a list of
+    (name, (width, height)) tuples. By default a 'web' rendition of
+    'jpg_size' and a 'thumb' rendition of 'thumb_size' are made. A
+    rendition is saved as <filename>_<name>.jpg and its filename is stored
+    under its name in the dictionary.
+
+    The 'image_formats' setting lists the formats every rendition is saved
+    in, 'jpg' (progressive) and/or 'webp'. WebP renditions use the
+    'webp_quality' setting or are lossless if 'webp_lossless' is set. The
+    first format is the one stored under the rendition's name, all files
+    and their byte sizes are listed in the 'formats' of the rendition.
     """
+    mimetype = None
+    modes = ('RGB', 'RGBA', 'CMYK', 'I')    # supported image modes
+    cpu_bound = True
+
     def __init__(self, *args, **kwargs):
-        super(appie.AppiePNGParser, self).__init__(*args, **kwargs)
+        super(appie.AppieImageParser, self).__init__(*args, **kwargs)
         self.jpg_size = appie.config.get('jpg_size', (1280, 720))
         self.thumb_size = appie.config.get('thumb_size', (384, 216))
+        self.renditions = appie.config.get('renditions',
+                    [('web', self.jpg_size), ('thumb', self.thumb_size)])
+        self.formats = list(appie.config.get('image_formats', ['jpg']))
+        for fmt in self.formats:
+            if fmt not in IMAGE_FORMATS:
+                raise ValueError("Unsupported image format: {0}".format(fmt))
+        self.webp_quality = appie.config.get('webp_quality', 80)
+        self.webp_lossless = appie.config.get('webp_lossless', False)
+
+    def cache_key(self):
+        return "{0}:{1}:{2}:{3}:{4}".format(super().cache_key(),
+                        self.renditions, self.formats, self.webp_quality,
+                        self.webp_lossless)
+
+    def convert(self, img):
+        """
+        Convert the opened image before resizing, returns the image
+        """
+        return img
+
+    def outputs(self, filename, d):
+        return [ f['file'] for r in d.get('renditions', [])
+                           for f in r['formats'] ]
 
-    def match(self, name):
-        if name.endswith('.png'):
-            return True
-        return False
+    def fit(self, size, box):
+        """
+        Returns the size of an image of size fitted into box keeping its
+        aspect ratio. Images are never enlarged.
+        """
+        scale = min(box[0] / size[0], box[1] / size[1], 1)
+        return (max(1, min(box[0], round(size[0] * scale))),
+                max(1, min(box[1], round(size[1] * scale))))
 
     def parse_file(self, path, filename, dest_path):
-        logging.debug("PNGParser parsing {0}".format(filename))
-        filepath = path
-        jpg_filename = os.path.splitext(filename)[0] + "_web.jpg"
-        thumb_filename = os.path.splitext(filename)[0] + "_thumb.jpg"
+        logging.debug("{0} parsing {1}".format(type(self).__name__, filename))
+        name = os.path.splitext(filename)[0]
 
-        img = Image.open(filepath)
+        # opening only reads the header, the image is decoded when needed
+        img = Image.open(path)
         size = img.size
-        if img.mode == 'RGBA':
-            img = img.convert("RGB")
-        if img.mode in ('RGB', 'CMYK', 'I'):
-            img.thumbnail(self.jpg_size, Image.ANTIALIAS)
-            img.save(os.path.join(dest_path, jpg_filename),
-                     "JPEG", quality=80, optimize=True,
-                     progressive=True)
-            img.thumbnail(self.thumb_size, Image.ANTIALIAS)
-            img.save(os.path.join(dest_path, thumb_filename), "JPEG",
-                     quality=80, optimize=True, progressive=True)
-        else:
+        # from large to small so every rendition is resized from the previous
+        renditions = sorted(( (rname, self.fit(size, box))
+                              for rname, box in self.renditions ),
+                            key=lambda r: r[1], reverse=True)
+        # renditions of the original's size and format are copies of it
+        copies = { (rname, fmt) for rname, rsize in renditions
+                   for fmt in self.formats
+                   if rsize == size and IMAGE_FORMATS[fmt][0] == img.format }
+        decode = [ (rname, rsize) for rname, rsize in renditions
+                   if any( (rname, fmt) not in copies for fmt in self.formats ) ]
+        if decode:
+            # only JPG supports decoding at a reduced scale, never below the
+            # largest rendition to encode
+            img.draft(img.mode, decode[0][1])
+            img = self.convert(img)
+        if img.mode not in self.modes:
             logger.warning("Image {0} is not a valid color image (mode={1})"
                            .format(filename, img.mode))
             return {'error': 'Not a valid color image'}
 
-        return {
-                'mimetype': 'image/png',    # https://www.w3.org/Graphics/PNG/
+        d = {
+                'mimetype': self.mimetype,
                 'size': size,              # tuple (width,height)
-                'web': jpg_filename,
-                'thumb': thumb_filename,
                 'path': dest_path,
-                'md5': 'todo'
-                }
+                'md5': None,               # filled in by the dir parser
+                'renditions': []
+            }
+        for rname, rsize in renditions:
+            formats = []
+            for fmt in self.formats:
+                rfilename = "{0}_{1}{2}".format(name, rname, IMAGE_FORMATS[fmt][1])
+                filepath = os.path.join(dest_path, rfilename)
+                if (rname, fmt) in copies:
+                    # re-encoding would only cost time and quality
+                    appie.publish_file(path, dest_path, name=rfilename)
+                    nbytes = os.path.getsize(filepath)
+                else:
+                    if img.size != rsize:
+                        img = img.resize(rsize, Image.LANCZOS)
+                    nbytes = self.save(img, filepath, fmt)
+                formats.append({ 'format': fmt, 'file': rfilename,
+                                 'mimetype': IMAGE_FORMATS[fmt][2],
+                                 'bytes': nbytes })
+            d[rname] = formats[0]['file']
+            d['renditions'].append({ 'name': rname, 'file': formats[0]['file'],
+                                     'size': rsize, 'formats': formats })
+        return d
+
+    def save(self, img, filepath, fmt):
+        """
+        Save a rendition in one of the IMAGE_FORMATS, returns the size of
+        the file in bytes
+        """
+        if fmt == 'webp':
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGB')
+            img.save(filepath, "WEBP", quality=self.webp_quality,
+                     lossless=self.webp_lossless)
+        else:
+            # JPG has no alpha channel
+            if img.mode == 'RGBA':
+                img = img.convert('RGB')
+            img.save(filepath, "JPEG", quality=80, optimize=True,
+                     progressive=True)
+        return os.path.getsize(filepath)
 
 
-class AppieJPGParser(appie.AppieFileParser):
+class AppiePNGParser(AppieImageParser):
     """
-    JPG parser converting JPGs to progressive JPG and a JPG thumb if they
-    are larger than the 'jpg_size' setting.
+    PNG parser converting PNGs to JPG renditions, by default a web sized
+    JPG and a JPG thumb. WebP renditions keep the alpha channel.
 
-    :note: to not parse JPG images and just copy them to the build root use
-           a captital extension (.JPG). The parsers are case sensitive!
+    :note: to not parse PNG images and just copy them to the build root
+           use a captital extension (.PNG). The parsers are case sensitive!
     """
-    def __init__(self, *args, **kwargs):
-        super(appie.AppieJPGParser, self).__init__(*args, **kwargs)
-        self.jpg_size = appie.config.get('jpg_size', (1280, 720))
-        self.thumb_size = appie.config.get('thumb_size', (384, 216))
+    match_suffixes = ('.png',)
+    mimetype = 'image/png'      # https://www.w3.org/Graphics/PNG/
+    modes = ('RGB', 'RGBA', 'CMYK', 'I')
 
-    def match(self, name):
-        if name.endswith('.jpg'):
-            return True
-        return False
+    def convert(self, img):
+        # only keep the alpha channel if a format can store it
+        if img.mode == 'RGBA' and 'webp' not in self.formats:
+            img = img.convert("RGB")
+        return img
 
-    def parse_file(self, path, filename, dest_path):
-        logging.debug("JPGParser parsing {0}".format(filename))
-        filepath = path
-        jpg_filename = os.path.splitext(filename)[0] + "_web.jpg"
-        thumb_filename = os.path.splitext(filename)[0] + "_thumb.jpg"
 
-        img = Image.open(filepath)
-        size = img.size
-        if img.mode in ('RGB', 'RGBA', 'CMYK', 'I'):
-            img.thumbnail(self.jpg_size, Image.ANTIALIAS)
-            img.save(os.path.join(dest_path, jpg_filename), "JPEG",
-                     quality=80, optimize=True, progressive=True)
-            img.thumbnail(self.thumb_size, Image.ANTIALIAS)
-            img.save(os.path.join(dest_path, thumb_filename), "JPEG",
-                     quality=80, optimize=True, progressive=True)
-        else:
-            logger.warning("Image {0} is not a valid color image (mode={1})"
-                           .format(filename, img.mode))
-            return {'error': 'Not a valid color image'}
+class AppieJPGParser(AppieImageParser):
+    """
+    JPG parser converting JPGs to progressive JPG renditions, by default a
+    JPG of at most the 'jpg_size' setting and a JPG thumb. JPGs already
+    within the size of a rendition are copied as is.
 
-        return {
-                'mimetype': 'image/jpg',   # https://www.w3.org/Graphics/PNG/
-                'size': size,              # tuple (width,height)
-                'web': jpg_filename,
-                'thumb': thumb_filename,
-                'path': dest_path,
-                'md5': 'todo'
-                }
+    :note: to not parse JPG images and just copy them to the build root use
+           a captital extension (.JPG). The parsers are case sensitive!
+    """
+    match_suffixes = ('.jpg',)
+    mimetype = 'image/jpg'
 
 
 class AppieMarkdownToFileParser(appie.AppieFileParser):
@@ -209,6 +436,12 @@ class AppieMarkdownToFileParser(appie.AppieFileParser):
            it saves the generated html to a file and saves meta data in
            json.
     """
+    markdown_extensions = MARKDOWN_EXTENSIONS
+    cpu_bound = True
+
+    def cache_key(self):
+        return "{0}:{1}".format(super().cache_key(), self.markdown_extensions)
+
     def __init__(self, match_extension=None, *args, **kwargs):
         """
         :param string match_extension: the extension to match on, by
@@ -219,10 +452,14 @@ class AppieMarkdownToFileParser(appie.AppieFileParser):
             self.match_ext = ".md.html"
         else:
             self.match_ext = match_extension
+        self.match_suffixes = (self.match_ext,)
 
-    def match(self, name):
-        if name.endswith(self.match_ext):
-            return True
+    def outputs(self, filename, d):
+        return [filename]
+
+    def references(self, filename, d, dest_path):
+        with open(os.path.join(dest_path, filename), encoding="utf8") as f:
+            return appie.html_links(f.read())
 
     def parse_file(self, path, filename, dest_path):
         logging.debug("MardownToFileParser parsing {0}".format(filename))
@@ -239,14 +476,7 @@ class AppieMarkdownToFileParser(appie.AppieFileParser):
         """
         Read the file and return the content parsed through markdown
         """
-        md = markdown.Markdown(
-                    extensions=[
-                        'markdown.extensions.tables',
-                        'markdown.extensions.meta',
-                        'markdown.extensions.codehilite',
-                        'markdown.extensions.toc'
-                        ]
-                    )
+        md = get_markdown(self.markdown_extensions)
         # generate the html from the .md file
         html = md.convert(self.load_file(file))
         meta = md.Meta
@@ -256,51 +486,278 @@ class AppieMarkdownToFileParser(appie.AppieFileParser):
 class AppieBlogDirParser(appie.AppieDirParser):
     """
     Matches on a directory named 'blog'. Then runs every .md file
-    with metadata into the blog.jinja2 file to create html files
+    with metadata into the blog.jinja2 file to create html files. A post
+    can use another template of the blog directory through a 'template'
+    meta data key.
+
+    The templates are compiled once and cached in the build directory. A
+    post is only rendered again if the post or its template (including the
+    templates it extends or includes) changed.
+
+    From the meta data of the posts (title, date, summary and tags) a
+    sorted index is kept to generate:
+
+    * listing pages: page1.html, page2.html, ... numbered from the oldest
+      posts so adding a post only changes the last page. index.html is a
+      copy of the last (newest) page.
+    * tag pages: tags/<tag>.html listing the posts of a tag
+    * an Atom feed of the newest posts: atom.xml
+
+    These are rendered through index.jinja2, tag.jinja2 and atom.jinja2
+    from the blog directory, if not found built-in templates are used.
+    Pages are only written if their content changed.
     """
-    def match(self, name):
-        if name == 'blog':
-            return True
+    match_names = ('blog',)
+    template = 'blog.jinja2'    # the default template of the posts
+    page_size = 10              # number of posts per listing page
+    feed_size = 20              # number of posts in the feed
 
     def parse_dir(self, path, dest_path, prev_dict=None):
         prev_dict = prev_dict or {}
         d = {}
-        tpl = Template(self.load_file(os.path.join(path, 'blog.jinja2')))
-        for item in os.scandir(path):
-            # save the relative! path in the buildroot instead of the original
-            web_path = dest_path.split(appie.config['target'])[1][1:]
-            if item.is_dir():
-                # subdirs are parsed as would be done normally
-                d[item.name] = self.parse_subdir(item, dest_path, prev_dict)
-            elif self.is_modified(item, prev_dict):
-                if item.name == "blog.jinja2":
-                    # skip the jinja2 template
-                    continue
-                # find a parser for this file
-                parser = appie.Appie.match_file_parsers(item.name)
-                d[item.name] = parser.parse_file(item.path, item.name,
-                                                 dest_path)
-                d[item.name]['path'] = web_path
-                d[item.name]['mtime'] = item.stat().st_mtime
-                if item.name.endswith(".md"):
-                    # run markdown parser output through jinja2
-                    html = tpl.render(d[item.name])
-                    fname, ext = os.path.splitext(item.name)
-                    self.save_file(html, os.path.join(dest_path, fname + ".html"))
-                    # rename the key
-                    d[fname + ".html"] = d[item.name]
-                    d.pop(item.name)
-                    continue
-                # copy file to dest if no content key
-                if not d[item.name].get('content') and parser.copyfile:
-                    logging.debug("Copy file {0} to the directory {1}"
-                                  .format(path, dest_path))
-                    shutil.copy(item.path, dest_path)
-            else:
-                d[item.name] = prev_dict[item.name]
+        # save the relative! path in the buildroot instead of the original
+        web_path = dest_path.split(appie.config['target'])[1][1:]
+        cache = appie.Appie.cache
+        env = get_jinja_env(path, os.path.join(
+                    os.path.dirname(cache.filepath) if cache
+                    else appie.config['target'], '.appie_jinja'),
+                    BLOG_TEMPLATES)
+        fingerprints = {}
+        posts = {}
+        profiler = appie.Appie.profiler
+        for item in appie.Appie.scandir(path):
+            if item.name.endswith(".jinja2"):
+                # skip the jinja2 templates
+                continue
+            is_post = not item.is_dir() and item.name.endswith(".md")
+            if self.is_listing(os.path.splitext(item.name)[0] + ".html"
+                               if is_post else item.name):
+                raise ValueError("{0} clashes with a listing page of the "
+                                 "blog, please rename it".format(item.path))
+            if not is_post:
+                # subdirs and other files are parsed as would be done normally
+                d[item.name] = self.parse_entry(item, dest_path, prev_dict)
+                continue
+            # posts are saved as html files
+            fname = os.path.splitext(item.name)[0] + ".html"
+            parser = appie.Appie.match_file_parsers(item.name)
+            prev = prev_dict.get(fname)
+            template = prev.get('template', [self.template])[0] if prev \
+                        else self.template
+            if template not in fingerprints:
+                fingerprints[template] = template_fingerprint(env, template)
+            key = "{0}:{1}:{2}".format(parser.cache_key(), template,
+                                       fingerprints[template])
+            if prev and not self.is_post_modified(item, prev, key):
+                if profiler:
+                    profiler.hit(item.path, self)
+                prev['mtime'] = item.stat().st_mtime
+                d[fname] = posts[fname] = prev
+                continue
+            sample = appie.AppieSample(item.path, type(self).__name__) \
+                        if profiler else None
+            with self.profile_step(sample, 'parse'):
+                post = parser.parse_file(item.path, item.name, dest_path)
+            post['path'] = web_path
+            post['mtime'] = item.stat().st_mtime
+            if post.get('template', [self.template])[0] != template:
+                template = post['template'][0]
+                if template not in fingerprints:
+                    fingerprints[template] = template_fingerprint(env, template)
+                key = "{0}:{1}:{2}".format(parser.cache_key(), template,
+                                           fingerprints[template])
+            # run markdown parser output through jinja2
+            with self.profile_step(sample, 'render'):
+                html = env.get_template(template).render(post)
+            self.save_file(html, os.path.join(dest_path, fname))
+            if cache:
+                st = item.stat()
+                templates = []
+                template_fingerprint(env, template, files=templates)
+                cache.update(item.path, appie.AppieRecord(st.st_mtime,
+                        st.st_size, appie.file_md5(item.path), key,
+                        [ web_path + '/' + fname if web_path else fname ],
+                        [ appie.resolve_link(link, web_path)
+                          for link in appie.html_links(html) ], templates))
+            d[fname] = posts[fname] = post
+            if sample:
+                profiler.add(sample.stop())
+
+        # the listing pages, tag pages and feed as a single sample
+        sample = appie.AppieSample(os.path.join(path, '(listings)'),
+                                   type(self).__name__) if profiler else None
+        with self.profile_step(sample, 'render'):
+            self.parse_listings(env, posts, d, dest_path, web_path, prev_dict)
+        if sample:
+            profiler.add(sample.stop())
+        return d
 
+    def profile_step(self, sample, name):
+        """
+        Returns a context manager measuring a step of a profiler sample,
+        which does nothing if not profiling
+        """
+        return sample.step(name) if sample else contextlib.nullcontext()
+
+    def is_listing(self, name):
+        """
+        Returns true if name is used by the listing pages, tag pages or feed
+        """
+        return re.match(r"(index|page\d+)\.html$|atom\.xml$|tags$", name) \
+                is not None
+
+    def listing_entry(self, fname, post):
+        """
+        Returns the entry of a post in the index
+        """
+        date = post.get('date', [''])[0]
+        if len(date) == 10:     # YYYY-MM-DD
+            updated = date + "T00:00:00Z"
+        else:
+            updated = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                    time.gmtime(post['mtime']))
+        return {
+            'file': fname,
+            'title': post.get('title', [os.path.splitext(fname)[0]])[0],
+            'date': date,
+            'updated': updated,
+            'summary': post.get('summary', [''])[0],
+            'tags': post.get('tags', [])
+        }
+
+    def parse_listings(self, env, posts, d, dest_path, web_path, prev_dict):
+        """
+        Render the listing pages, tag pages and feed of the posts and add
+        them to the dictionary of the blog directory
+
+        :param jinja2.Environment env: the environment of the blog
+        :param dict posts: the dictionaries of the posts by filename
+        :param dict d: the dictionary of the blog directory
+        :param str dest_path: path of the blog in the buildroot
+        :param str web_path: relative path of the blog in the buildroot
+        :param dict prev_dict: the dictionary of the previous run
+        """
+        # oldest first, pages are numbered from the oldest posts
+        index = sorted(( self.listing_entry(fname, post)
+                         for fname, post in posts.items() ),
+                       key=lambda e: (e['updated'], e['file']))
+        chunks = [ index[i:i + self.page_size]
+                   for i in range(0, len(index), self.page_size) ] or [[]]
+        names = [ "page{0}.html".format(n + 1) for n in range(len(chunks)) ]
+        for n, chunk in enumerate(chunks):
+            context = { 'posts': chunk[::-1], 'page': n + 1,
+                        'pages': len(chunks),
+                        'newer': names[n + 1] if n + 1 < len(chunks) else None,
+                        'older': names[n - 1] if n else None }
+            d[names[n]] = self.render_page(env, 'index.jinja2', context,
+                                           dest_path, names[n], web_path)
+        d['index.html'] = self.render_page(env, 'index.jinja2', context,
+                                           dest_path, 'index.html', web_path)
+        # pages of the previous run which are gone
+        for name in prev_dict:
+            if re.match(r"page\d+\.html$", name) and name not in d:
+                self.remove_page(os.path.join(dest_path, name))
+
+        # tag pages
+        tags = {}
+        for entry in index:
+            for tag in entry['tags']:
+                tags.setdefault(tag, []).append(entry)
+        tags_path = os.path.join(dest_path, 'tags')
+        tags_web_path = web_path + '/tags' if web_path else 'tags'
+        os.makedirs(tags_path, exist_ok=True)
+        d['tags'] = { 'path': web_path,
+                      'mtime': os.stat(tags_path).st_mtime }
+        for tag, name in self.tag_names(tags).items():
+            entries = tags[tag]
+            d['tags'][name] = self.render_page(env, 'tag.jinja2',
+                                { 'tag': tag, 'posts': entries[::-1] },
+                                tags_path, name, tags_web_path)
+            d['tags'][name]['tag'] = tag
+        for name in prev_dict.get('tags', {}):
+            if name.endswith(".html") and name not in d['tags']:
+                self.remove_page(os.path.join(tags_path, name))
+
+        # the feed of the newest posts
+        feed = index[-self.feed_size:][::-1]
+        url = appie.config.get('url', '').rstrip('/') + '/'
+        url += web_path + '/' if web_path else ''
+        d['atom.xml'] = self.render_page(env, 'atom.jinja2',
+                            { 'title': web_path or 'blog', 'url': url,
+                              'updated': feed[0]['updated'] if feed else
+                                         "1970-01-01T00:00:00Z",
+                              'posts': feed },
+                            dest_path, 'atom.xml', web_path)
+
+    def tag_names(self, tags):
+        """
+        Returns the filename of the page of every tag. Tags with the same
+        slug (i.e. 'a b' and 'a-b') get a numbered suffix, in order of the
+        tags so the names are stable.
+        """
+        names = {}
+        used = set()
+        for tag in sorted(tags):
+            slug = re.sub(r"[^\w-]+", "-", tag.lower())
+            name, n = slug + ".html", 1
+            while name in used:
+                n += 1
+                name = "{0}-{1}.html".format(slug, n)
+            used.add(name)
+            names[tag] = name
+        return names
+
+    def render_page(self, env, template, context, dest_path, name, web_path):
+        """
+        Render a listing page to dest_path/name unless its content did not
+        change since the previous run. Returns the dictionary of the page.
+
+        :param jinja2.Environment env: the environment of the blog
+        :param str template: name of the template
+        :param dict context: the context of the template
+        :param str dest_path: the directory to save the page in
+        :param str name: the filename of the page
+        :param str web_path: relative path of dest_path in the buildroot
+        """
+        filepath = os.path.join(dest_path, name)
+        digest = hashlib.md5(json.dumps([ template_fingerprint(env, template),
+                        context ], sort_keys=True).encode('utf8')).hexdigest()
+        cache = appie.Appie.cache
+        rec = cache.records.get(filepath) if cache else None
+        if not rec or rec.md5 != digest or not os.path.exists(filepath):
+            self.save_file(env.get_template(template).render(context), filepath)
+        if cache:
+            cache.update(filepath, appie.AppieRecord(None, None, digest,
+                    "{0}:{1}".format(type(self).__name__, template),
+                    [ web_path + '/' + name if web_path else name ]))
+        d = { 'path': web_path, 'mtime': os.stat(filepath).st_mtime,
+              'posts': [ e['file'] for e in context['posts'] ] }
+        if 'page' in context:
+            d['page'] = context['page']
+            d['pages'] = context['pages']
         return d
 
+    def remove_page(self, filepath):
+        """
+        Remove a listing page which is no longer generated
+        """
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+
+    def is_post_modified(self, item, prev, key):
+        """
+        Check whether a post needs to be rendered again
+
+        :param item: os.DirEntry of the post
+        :param dict prev: the dictionary of the post from the previous run
+        :param str key: the cache key of the post, its parser and template
+        """
+        if appie.Appie.cache is None:
+            return item.stat().st_mtime > prev['mtime']
+        return appie.Appie.cache.is_modified(item.path, item.stat(), key)
+
     def load_file(self, path, mode='r'):
         """
         parse the file and return the content for the dict
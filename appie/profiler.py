@@ -0,0 +1,216 @@
+# Appie build profiler
+#
+# Copyright (c) 2015, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License v3 for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+import os
+import time
+import json
+import contextlib
+
+
+def io_counters(thread=False):
+    """
+    Returns a tuple of the number of bytes read and written by this
+    process. Only available on Linux, (0, 0) elsewhere.
+
+    :param bool thread: count the bytes of the current thread only
+    """
+    try:
+        with open('/proc/thread-self/io' if thread else '/proc/self/io',
+                  'rb') as f:
+            counters = dict(line.split(b':') for line in f)
+        return int(counters[b'rchar']), int(counters[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class AppieSample(object):
+    """
+    Measures the wall time, CPU time and bytes read and written of a
+    piece of work in the current thread, so work done concurrently by
+    other threads (i.e. in async builds) is not counted. Time spent in
+    named steps (i.e. hashing or publishing) is accumulated separately.
+    """
+    def __init__(self, name, category, thread=True):
+        """
+        :param str name: the name of the sample, i.e. the path of a file
+        :param str category: the category, i.e. the parser class name
+        :param bool thread: measure the current thread only, otherwise
+                            the whole process
+        """
+        self.name = name
+        self.category = category
+        self.pid = os.getpid()
+        self.steps = {}
+        self.start = time.time()
+        self._thread = thread
+        self._clock = time.thread_time if thread else time.process_time
+        self._wall = time.perf_counter()
+        self._cpu = self._clock()
+        self._io = io_counters(thread)
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """
+        Context manager adding the wall time of its block to the step name
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0) + time.perf_counter() - t
+
+    def stop(self, cache='miss'):
+        """
+        Stop measuring, returns the sample as a dictionary
+
+        :param str cache: 'miss' if the file was parsed, 'hit' if the
+                          previous result was reused
+        """
+        rchar, wchar = io_counters(self._thread)
+        return {
+            'name': self.name,
+            'parser': self.category,
+            'cache': cache,
+            'pid': self.pid,
+            'start': self.start,
+            'wall': time.perf_counter() - self._wall,
+            'cpu': self._clock() - self._cpu,
+            'read': rchar - self._io[0],
+            'written': wchar - self._io[1],
+            'steps': self.steps
+        }
+
+
+class AppieProfiler(object):
+    """
+    Collects the samples of a build. Files are sampled in parse_file_job,
+    possibly in a worker process, and the samples are added when the job
+    is finished. Directory parsers doing their own work (like the blog)
+    add samples of it themselves. Files whose previous result is reused are added as cache
+    hits. The build phases (scanning, parsing, saving) are measured as
+    well.
+    """
+    def __init__(self):
+        self.samples = []
+        self.phases = []
+
+    def add(self, sample):
+        """
+        Add a sample returned by AppieSample.stop
+        """
+        self.samples.append(sample)
+
+    def hit(self, name, parser):
+        """
+        Add a cache hit for a file
+
+        :param str name: path of the file
+        :param parser: the parser matching the file
+        """
+        self.add(AppieSample(name, type(parser).__name__).stop('hit'))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager measuring a phase of the build, of all threads
+        """
+        sample = AppieSample(name, 'phase', thread=False)
+        try:
+            yield
+        finally:
+            self.phases.append(sample.stop(None))
+
+    def parsers(self):
+        """
+        Returns a dictionary of the totals per parser class
+        """
+        totals = {}
+        for s in self.samples:
+            t = totals.setdefault(s['parser'], { 'files': 0, 'hit': 0,
+                        'miss': 0, 'wall': 0, 'cpu': 0, 'read': 0,
+                        'written': 0, 'steps': {} })
+            t['files'] += 1
+            t[s['cache']] += 1
+            for k in ('wall', 'cpu', 'read', 'written'):
+                t[k] += s[k]
+            for k, v in s['steps'].items():
+                t['steps'][k] = t['steps'].get(k, 0) + v
+        return totals
+
+    def report(self, top=10):
+        """
+        Returns a summary of the build as text: the phases, the totals per
+        parser and the slowest files
+
+        :param int top: the number of slowest files to list
+        """
+        lines = ["{0:<32} {1:>9}".format("phase", "wall(s)")]
+        for p in self.phases:
+            lines.append("{0:<32} {1:>9.3f}".format(p['name'], p['wall']))
+        lines.append("")
+        lines.append("{0:<32} {1:>6} {2:>6} {3:>9} {4:>9} {5:>10} {6:>10}  {7}"
+                     .format("parser", "hit", "miss", "wall(s)", "cpu(s)",
+                             "read", "written", "steps(s)"))
+        for name, t in sorted(self.parsers().items(),
+                              key=lambda i: i[1]['wall'], reverse=True):
+            lines.append("{0:<32} {1:>6} {2:>6} {3:>9.3f} {4:>9.3f} {5:>10} {6:>10}  {7}"
+                         .format(name, t['hit'], t['miss'], t['wall'], t['cpu'],
+                                 t['read'], t['written'],
+                                 " ".join("{0}={1:.3f}".format(k, v)
+                                          for k, v in sorted(t['steps'].items()))))
+        lines.append("")
+        lines.append("{0:>9} {1:>9}  {2:<24} {3}".format("wall(s)", "cpu(s)",
+                                                        "parser", "file"))
+        slowest = sorted(( s for s in self.samples if s['cache'] == 'miss' ),
+                         key=lambda s: s['wall'], reverse=True)
+        for s in slowest[:top]:
+            lines.append("{0:>9.3f} {1:>9.3f}  {2:<24} {3}".format(s['wall'],
+                                            s['cpu'], s['parser'], s['name']))
+        return "\n".join(lines)
+
+    def save(self, filepath, fmt='json'):
+        """
+        Save the report to a file
+
+        :param str filepath: path of the report
+        :param str fmt: 'json' for the samples and totals or 'trace' for the
+                        Chrome trace event format (chrome://tracing)
+        """
+        if fmt == 'trace':
+            data = { 'traceEvents': self.trace_events(),
+                     'displayTimeUnit': 'ms' }
+        else:
+            data = { 'phases': self.phases, 'parsers': self.parsers(),
+                     'files': self.samples }
+        with open(filepath, 'w') as f:
+            json.dump(data, f, indent=1)
+
+    def trace_events(self):
+        """
+        Returns the phases and samples as complete events of the Chrome
+        trace event format, one row per process
+        """
+        events = []
+        for s in self.phases + self.samples:
+            events.append({ 'name': s['name'], 'cat': s['parser'], 'ph': 'X',
+                            'ts': s['start'] * 1e6, 'dur': s['wall'] * 1e6,
+                            'pid': 0 if s['parser'] == 'phase' else s['pid'],
+                            'tid': s['pid'],
+                            'args': { 'cache': s['cache'], 'cpu': s['cpu'],
+                                      'read': s['read'],
+                                      'written': s['written'],
+                                      'steps': s['steps'] } })
+        return events
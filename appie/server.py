@@ -0,0 +1,324 @@
+# Appie development webserver
+#
+# Copyright (c) 2015, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License v3 for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+import os
+import io
+import gzip
+import time
+import threading
+import collections
+import logging
+import socketserver
+import http.server
+import email.utils
+
+logger = logging.getLogger(__name__)
+
+
+class AppieHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Request handler serving the buildroot. Adds ETag and Last-Modified
+    headers and answers conditional requests with 304 Not Modified. If
+    the client accepts it, the brotli or gzip sidecar written by a build
+    with config['compress'] is sent, otherwise text files like all.json
+    are gzipped. Files are sent using sendfile.
+    """
+    compress_types = ('application/json', 'application/javascript',
+                      'image/svg+xml')  # and text/*
+    # Content-Encoding and suffix of the sidecars, in order of preference
+    sidecars = (('br', '.br'), ('gzip', '.gz'))
+
+    def translate_path(self, path):
+        # serve from the server's root instead of the working directory
+        path = super().translate_path(path)
+        return os.path.join(self.server.root, os.path.relpath(path, os.getcwd()))
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path) or self.path.endswith('/'):
+            # directory listings, redirects and errors
+            return super().send_head()
+        ctype = self.guess_type(path)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        st = os.fstat(f.fileno())
+        etag = '"{0:x}-{1:x}"'.format(st.st_mtime_ns, st.st_size)
+        accept = [ e.split(';')[0].strip() for e in
+                   self.headers.get('Accept-Encoding', '').split(',') ]
+        encoding, sidecar = self.open_sidecar(path, st, accept)
+        compress = not sidecar and 'gzip' in accept and \
+                (ctype.startswith('text/') or ctype in self.compress_types)
+        if compress:
+            encoding = 'gzip'
+        if encoding:
+            etag = etag[:-1] + '-' + encoding + '"'
+
+        if self.not_modified(etag, st.st_mtime):
+            f.close()
+            if sidecar:
+                sidecar.close()
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        length = st.st_size
+        if sidecar:
+            f.close()
+            f = sidecar
+            length = os.fstat(f.fileno()).st_size
+        elif compress:
+            data = self.server.gzipped(path, f, st)
+            f.close()
+            f = io.BytesIO(data)
+            length = len(data)
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        return f
+
+    def open_sidecar(self, path, st, accept):
+        """
+        Returns the encoding and the opened sidecar of a file if the
+        client accepts its encoding and it is up to date, i.e. has the
+        mtime of the file, otherwise (None, None)
+
+        :param str path: path of the file
+        :param os.stat_result st: stat result of the opened file
+        :param list accept: the encodings the client accepts
+        """
+        for encoding, suffix in self.sidecars:
+            if encoding not in accept:
+                continue
+            try:
+                f = open(path + suffix, 'rb')
+            except OSError:
+                continue
+            if os.fstat(f.fileno()).st_mtime_ns == st.st_mtime_ns:
+                return encoding, f
+            f.close()
+        return None, None
+
+    def not_modified(self, etag, mtime):
+        """
+        Returns true if the client's copy is still valid
+        """
+        if 'If-None-Match' in self.headers:
+            tags = [ t.strip() for t in self.headers['If-None-Match'].split(',') ]
+            return etag in tags or '*' in tags
+        if 'If-Modified-Since' in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(
+                                        self.headers['If-Modified-Since'])
+            except (TypeError, ValueError, IndexError):
+                return False
+            return since is not None and int(mtime) <= since.timestamp()
+        return False
+
+    def copyfile(self, source, outputfile):
+        try:
+            source.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return super().copyfile(source, outputfile)
+        # the file goes from the page cache to the socket in the kernel
+        self.connection.sendfile(source)
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s" % (self.address_string(), format % args))
+
+
+class AppieHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP server handling every request in its own thread so slow clients
+    or large downloads don't block other requests or the file watching
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    gzip_cache_size = 16 << 20  # bytes of gzipped files kept in memory
+
+    def __init__(self, address, root, handler=AppieHTTPRequestHandler):
+        """
+        :param tuple address: (host, port) to listen on
+        :param str root: the directory to serve
+        """
+        super().__init__(address, handler)
+        self.root = os.path.abspath(root)
+        self._gzipped = collections.OrderedDict()  # path: (mtime_ns, size, data)
+        self._gzipped_bytes = 0     # total size of the cached data
+        self._lock = threading.Lock()
+
+    def gzipped(self, path, f, st):
+        """
+        Returns the gzipped content of a file, compressed once per version
+        of the file. The least recently served files are dropped from the
+        cache when it exceeds gzip_cache_size bytes.
+
+        :param str path: path of the file
+        :param file f: the opened file
+        :param os.stat_result st: stat result of the opened file
+        """
+        with self._lock:
+            cached = self._gzipped.get(path)
+            if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+                self._gzipped.move_to_end(path)
+                return cached[2]
+        data = gzip.compress(f.read())
+        with self._lock:
+            old = self._gzipped.pop(path, None)
+            if old:
+                self._gzipped_bytes -= len(old[2])
+            if len(data) <= self.gzip_cache_size:
+                self._gzipped[path] = (st.st_mtime_ns, st.st_size, data)
+                self._gzipped_bytes += len(data)
+            while self._gzipped_bytes > self.gzip_cache_size:
+                self._gzipped_bytes -= len(self._gzipped.popitem(last=False)[1][2])
+        return data
+
+
+class AppieRebuildScheduler(object):
+    """
+    Runs the rebuilds of the watch mode in a background thread so the
+    server keeps answering requests with the last built output. Changes
+    are collected until none arrived for 'delay' seconds, or for at most
+    'max_delay' seconds after the first one, and are then built at once.
+    Changes arriving during a build supersede it: the build stops after
+    the path it is parsing and its remaining paths are built together
+    with the new changes.
+    """
+    def __init__(self, build, delay=0.3, max_delay=None):
+        """
+        :param build: callable(paths, moves, cancelled) running the build
+                      like Appie.update, returns the paths not built
+                      because cancelled() returned true
+        :param float delay: seconds to wait for more changes
+        :param float max_delay: maximum seconds to wait after the first
+                                change, defaults to ten times delay
+        """
+        self.build = build
+        self.delay = delay
+        self.max_delay = delay * 10 if max_delay is None else max_delay
+        self.builds = 0         # number of finished builds
+        self._paths = {}        # pending paths, a dict to keep their order
+        self._moves = []        # pending (old path, new path) moves
+        self._first = None      # time of the first pending change
+        self._last = None       # time of the last pending change
+        self._running = False   # a build is running
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="appie-rebuild")
+
+    def start(self):
+        """
+        Start the build thread, returns the scheduler
+        """
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the build thread after the running build, pending changes are
+        dropped
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def schedule(self, paths=(), moves=()):
+        """
+        Schedule a build of changed paths
+
+        :param iterable paths: changed (or removed) files or directories
+        :param iterable moves: (old path, new path) tuples of renames
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._paths.update(dict.fromkeys(paths))
+            self._moves.extend(moves)
+            if self._first is None:
+                self._first = now
+            self._last = now
+            self._cond.notify()
+
+    def pending(self):
+        """
+        Returns true if changes are waiting to be built
+        """
+        with self._cond:
+            return bool(self._paths or self._moves)
+
+    def idle(self):
+        """
+        Returns true if no changes are waiting and no build is running
+        """
+        with self._cond:
+            return not (self._paths or self._moves or self._running)
+
+    def _next(self):
+        """
+        Wait until the pending changes are due, returns them as a (paths,
+        moves) tuple or None if stopped
+        """
+        with self._cond:
+            while not self._stopped:
+                if self._first is None:
+                    self._cond.wait()
+                    continue
+                due = min(self._last + self.delay, self._first + self.max_delay)
+                now = time.monotonic()
+                if now < due:
+                    self._cond.wait(due - now)
+                    continue
+                batch = list(self._paths), self._moves
+                self._paths, self._moves = {}, []
+                self._first = self._last = None
+                self._running = True
+                return batch
+            return None
+
+    def _run(self):
+        while True:
+            batch = self._next()
+            if batch is None:
+                return
+            paths, moves = batch
+            logger.info("Rebuilding {0} path(s), moving {1}"
+                        .format(len(paths), len(moves)))
+            remaining = ()
+            try:
+                remaining = self.build(paths, moves, self.pending) or ()
+            except Exception:
+                logger.exception("Rebuild failed, serving the previous output")
+            with self._cond:
+                self._running = False
+                self.builds += 1
+                if remaining:
+                    # superseded, build them with the newer changes
+                    paths = dict.fromkeys(remaining)
+                    paths.update(self._paths)
+                    self._paths = paths
+                self._cond.notify_all()
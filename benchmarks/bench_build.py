@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+#
+# Copyright (c) 2015, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License v3 for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+"""
+Benchmark of complete builds of a synthetic site (see sitegen.py). Times
+
+* cold: a build without a previous build
+* warm: a build without any changes (no-op)
+* incremental: a build after changing a single markdown page
+* update: Appie.update of the changed page, like the watch mode does
+
+The results are saved to benchmarks/results/<commit>.json so a build can
+be compared with the results of another commit:
+
+    $ python3 benchmarks/bench_build.py --markdown 2000 --images 40
+    $ git checkout other-branch
+    $ python3 benchmarks/bench_build.py --markdown 2000 --images 40 --compare master
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import appie
+import sitegen
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def git_commit(rev='HEAD'):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', rev],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def touch_page(path, i):
+    with open(path, 'a', encoding="utf8") as f:
+        f.write("\nChanged {0}\n".format(i))
+
+
+def setup_appie(src, target, jobs):
+    appie.config['src'] = [src]
+    appie.config['target'] = target
+    appie.config['jobs'] = jobs
+    a = appie.Appie()
+    for p in (appie.AppieTextileParser(), appie.AppieMarkdownParser(),
+              appie.AppiePNGParser(), appie.AppieJPGParser()):
+        a.add_file_parser(p)
+    a.add_directory_parser(appie.AppieBlogDirParser())
+    return a
+
+
+def run(args):
+    """
+    Generate the site and run the scenarios, returns the results
+    """
+    tmp = tempfile.mkdtemp()
+    src = os.path.join(tmp, 'src')
+    target = os.path.join(tmp, 'build')
+    try:
+        start = time.perf_counter()
+        generated = sitegen.generate_args(src, args)
+        print("Generated site in {0:.1f}s".format(time.perf_counter() - start))
+        a = setup_appie(src, target, args.jobs)
+        page = (generated['markdown'] or generated['textile'])[-1]
+        times = { 'cold': [], 'warm': [], 'incremental': [], 'update': [] }
+        for r in range(args.repeat):
+            shutil.rmtree(target, ignore_errors=True)
+            a.tree = None
+            times['cold'].append(timed(a.parse))
+            times['warm'].append(timed(a.parse))
+            touch_page(page, r)
+            times['incremental'].append(timed(a.parse))
+            touch_page(page, r)
+            times['update'].append(timed(a.update, [page]))
+    finally:
+        shutil.rmtree(tmp)
+    return { name: { 'min': min(t), 'median': statistics.median(t), 'runs': t }
+             for name, t in times.items() }
+
+
+def load_results(name):
+    """
+    Load saved results by commit or path
+    """
+    path = name if os.path.isfile(name) else \
+           os.path.join(RESULTS, (git_commit(name) or name) + '.json')
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Appie build benchmark')
+    sitegen.add_arguments(argparser)
+    argparser.add_argument('-j', '--jobs', help='number of processes used to parse files', default=1, type=int)
+    argparser.add_argument('-r', '--repeat', help='number of times to run every scenario', default=3, type=int)
+    argparser.add_argument('-o', '--output', help='file to save the results to, defaults to benchmarks/results/<commit>.json', default=None)
+    argparser.add_argument('--compare', help='commit or results file to compare with', default=None)
+    args = argparser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': { k: v for k, v in vars(args).items()
+                  if k not in ('output', 'compare') },
+        'results': run(args)
+    }
+    output = args.output or os.path.join(RESULTS,
+                                    (results['commit'] or 'results') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    base = load_results(args.compare) if args.compare else None
+    if base and base['args'] != results['args']:
+        print("Warning: {0} was run with other arguments".format(args.compare))
+    print("{0:<12} {1:>10} {2:>10} {3:>10}".format("scenario", "min(s)",
+                                                 "median(s)", "vs base"))
+    for name, r in results['results'].items():
+        ratio = ""
+        if base and name in base['results']:
+            ratio = "{0:>9.2f}x".format(r['min'] / base['results'][name]['min'])
+        print("{0:<12} {1:>10.3f} {2:>10.3f} {3:>10}".format(name, r['min'],
+                                                         r['median'], ratio))
+    print("Results saved to {0}".format(output))
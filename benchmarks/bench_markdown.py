@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+#
+# Copyright (c) 2015, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License v3 for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+"""
+Micro benchmark of the per file cost of the markdown parser, comparing a
+new markdown.Markdown instance per file with the reused converter.
+
+    $ python3 benchmarks/bench_markdown.py -n 3000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import markdown
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import appie
+
+DOCUMENT = """title: Post {0}
+date: 2016-11-04
+tags: tag1
+      tag2
+
+Post {0}
+========
+
+Some *text* with a [link](http://example.com/{0}) and a table:
+
+| a | b |
+|---|---|
+| {0} | {0} |
+
+    :::python
+    def post():
+        return {0}
+"""
+
+
+class AppieNewMarkdownParser(appie.AppieMarkdownParser):
+    """
+    The markdown parser as it was, creating a converter for every file
+    """
+    def parse_md(self, file):
+        md = markdown.Markdown(extensions=list(self.markdown_extensions))
+        html = md.convert(self.load_file(file))
+        return md.Meta, html
+
+
+def run(parser, paths):
+    start = time.perf_counter()
+    for path in paths:
+        parser.parse_file(path, os.path.basename(path), None)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Markdown parser micro benchmark')
+    argparser.add_argument('-n', '--files', help='number of markdown files', default=3000, type=int)
+    args = argparser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(tmp, 'post{0}.md'.format(i))
+            with open(path, 'w') as f:
+                f.write(DOCUMENT.format(i))
+            paths.append(path)
+        for parser in (AppieNewMarkdownParser(), appie.AppieMarkdownParser()):
+            t = run(parser, paths)
+            print("{0:<24} {1:8.3f}s {2:8.3f}ms per file".format(
+                    type(parser).__name__, t, t * 1000 / len(paths)))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+#
+# Copyright (c) 2015, Arnaud Loonstra, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License v3 for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+"""
+Generates a synthetic source tree to benchmark Appie with. The files are
+spread over a tree of directories of the given depth and fanout. Content
+is generated from a seed so the same arguments give the same site.
+
+    $ python3 benchmarks/sitegen.py /tmp/site --markdown 1000 --images 50
+"""
+import argparse
+import os
+import random
+
+MARKDOWN = """title: Page {0}
+date: 2016-11-{1:02d}
+summary: Summary of page {0}.
+tags: tag{2}
+      tag{3}
+
+Page {0}
+========
+
+{4}
+
+| a | b |
+|---|---|
+| {0} | {2} |
+
+    :::python
+    def page():
+        return {0}
+"""
+
+TEXTILE = """h1. Page {0}
+
+{4}
+
+* item {2}
+* item {3}
+"""
+
+BLOG_TEMPLATE = """<!DOCTYPE html>
+<html>
+  <head><title>{{ title[0] }}</title></head>
+  <body>
+    <p>{{ summary[0] }}</p>
+    <div class="container">{{ content }}</div>
+    <p>{{ date[0] }}</p>
+    <ul>{% for n in tags %}<li>{{n}}</li>{% endfor %}</ul>
+  </body>
+</html>
+"""
+
+WORDS = ("appie static site generator json parse build image markdown "
+         "textile blog directory file render cache thumb web").split()
+
+
+def paragraph(rnd, words=80):
+    return " ".join(rnd.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def directories(root, depth, fanout):
+    """
+    Returns the list of directories of a tree of the given depth with
+    fanout subdirectories per directory, including root
+    """
+    dirs = [root]
+    level = [root]
+    for d in range(depth):
+        level = [ os.path.join(parent, "dir{0}".format(i))
+                  for parent in level for i in range(fanout) ]
+        dirs.extend(level)
+    return dirs
+
+
+def write_page(path, template, i, rnd):
+    with open(path, 'w', encoding="utf8") as f:
+        f.write(template.format(i, i % 28 + 1, rnd.randrange(10),
+                                rnd.randrange(10), paragraph(rnd)))
+
+
+def write_image(path, size, rnd):
+    from PIL import Image
+    # a gradient with noise compresses like a photo, unlike a flat color
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = Image.effect_noise(size, rnd.randrange(20, 60)).convert('RGB')
+    Image.blend(img, noise, 0.5).save(path)
+
+
+def generate(root, markdown=100, textile=100, images=10,
+             image_sizes=((1920, 1080),), blogs=1, posts=20, files=10,
+             depth=2, fanout=3, seed=0):
+    """
+    Generate a source tree, returns a dictionary of the generated paths
+
+    :param str root: directory to generate the site in
+    :param int markdown: number of markdown (.md) pages
+    :param int textile: number of textile pages
+    :param int images: number of images, alternating PNG and JPG
+    :param tuple image_sizes: (width, height) sizes of the images
+    :param int blogs: number of blog directories
+    :param int posts: number of posts per blog directory
+    :param int files: number of static files copied to the buildroot
+    :param int depth: depth of the directory tree
+    :param int fanout: number of subdirectories per directory
+    :param int seed: seed of the random content
+    """
+    rnd = random.Random(seed)
+    dirs = directories(root, depth, fanout)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    generated = { 'dirs': dirs, 'markdown': [], 'textile': [], 'images': [],
+                  'posts': [], 'files': [] }
+    for i in range(markdown):
+        path = os.path.join(dirs[i % len(dirs)], "page{0}.md".format(i))
+        write_page(path, MARKDOWN, i, rnd)
+        generated['markdown'].append(path)
+    for i in range(textile):
+        path = os.path.join(dirs[i % len(dirs)], "page{0}.textile".format(i))
+        write_page(path, TEXTILE, i, rnd)
+        generated['textile'].append(path)
+    for i in range(images):
+        ext = 'png' if i % 2 else 'jpg'
+        path = os.path.join(dirs[i % len(dirs)], "image{0}.{1}".format(i, ext))
+        write_image(path, tuple(image_sizes[i % len(image_sizes)]), rnd)
+        generated['images'].append(path)
+    for i in range(files):
+        path = os.path.join(dirs[i % len(dirs)], "file{0}.bin".format(i))
+        with open(path, 'wb') as f:
+            f.write(rnd.getrandbits(8 * 64 * 1024).to_bytes(64 * 1024, 'little'))
+        generated['files'].append(path)
+    # blogs are spread over the tree as well, the blog parser matches on
+    # the directory name so every one is a 'blog' dir in its own section
+    for b in range(blogs):
+        blog = os.path.join(dirs[b % len(dirs)], "section{0}".format(b), "blog")
+        os.makedirs(blog, exist_ok=True)
+        with open(os.path.join(blog, "blog.jinja2"), 'w') as f:
+            f.write(BLOG_TEMPLATE)
+        for i in range(posts):
+            path = os.path.join(blog, "post{0}.md".format(i))
+            write_page(path, MARKDOWN, i, rnd)
+            generated['posts'].append(path)
+    return generated
+
+
+def size(s):
+    w, h = s.lower().split('x')
+    return int(w), int(h)
+
+
+def add_arguments(argparser):
+    """
+    Add the generator options to an argparse parser
+    """
+    argparser.add_argument('--markdown', help='number of markdown pages', default=100, type=int)
+    argparser.add_argument('--textile', help='number of textile pages', default=100, type=int)
+    argparser.add_argument('--images', help='number of PNG and JPG images', default=10, type=int)
+    argparser.add_argument('--image-size', help='size of the images as WIDTHxHEIGHT, can be given multiple times', action='append', type=size, default=None)
+    argparser.add_argument('--blogs', help='number of blog directories', default=1, type=int)
+    argparser.add_argument('--posts', help='number of posts per blog', default=20, type=int)
+    argparser.add_argument('--files', help='number of static files', default=10, type=int)
+    argparser.add_argument('--depth', help='depth of the directory tree', default=2, type=int)
+    argparser.add_argument('--fanout', help='subdirectories per directory', default=3, type=int)
+    argparser.add_argument('--seed', help='seed of the generated content', default=0, type=int)
+
+
+def generate_args(root, args):
+    """
+    Generate a site from parsed add_arguments options
+    """
+    return generate(root, markdown=args.markdown, textile=args.textile,
+                    images=args.images,
+                    image_sizes=args.image_size or [(1920, 1080)],
+                    blogs=args.blogs, posts=args.posts, files=args.files,
+                    depth=args.depth, fanout=args.fanout, seed=args.seed)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Generate a synthetic Appie source tree')
+    argparser.add_argument('root', help='directory to generate the site in')
+    add_arguments(argparser)
+    args = argparser.parse_args()
+    generated = generate_args(args.root, args)
+    print("Generated {0} directories, {1} pages, {2} images and {3} posts in {4}"
+          .format(len(generated['dirs']),
+                  len(generated['markdown']) + len(generated['textile']),
+                  len(generated['images']), len(generated['posts']), args.root))
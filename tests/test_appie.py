@@ -3,7 +3,12 @@ import unittest
 import shutil
 import os
 import json
+import gzip
+import hashlib
+import tempfile
+import threading
 import appie
+import appie.compress
 import appie.extensions
 
 if sys.version.startswith('3'):
@@ -31,6 +36,16 @@ class AppieTest(unittest.TestCase):
             elif k == 'mtime':
                 d[k] = 0
 
+    def check_formats(self, entry, dest="./build/img"):
+        # every rendition lists its files and their byte sizes
+        for r in entry['renditions']:
+            formats = r.pop('formats')
+            self.assertEqual(formats[0]['file'], r['file'])
+            for f in formats:
+                self.assertTrue(os.path.isfile(os.path.join(dest, f['file'])))
+                self.assertGreater(f['bytes'], 0)
+        return entry
+
     def test_appie(self):
         jstruct = { '_test': {
                         'content': 'Testing\n', 
@@ -161,6 +176,16 @@ class AppieTest(unittest.TestCase):
             html = f.read()
         self.assertEqual(html, "<h1 id=\"a-heading\">A heading</h1>\n<p>This is the first paragraph of the document.</p>")
 
+    def test_markdown_reuse(self):
+        p = appie.AppieMarkdownParser()
+        meta = p.parse_file(os.path.join(self.sitesrc, 'blog.md.html'), 'blog.md.html', './build')
+        self.assertEqual(meta['title'], ['My Document'])
+        md = appie.extensions.get_markdown()
+        # the converter is reused but reset between documents
+        meta = p.parse_file(os.path.join(self.sitesrc, 'test.md'), 'test.md', './build')
+        self.assertIs(md, appie.extensions.get_markdown())
+        self.assertEqual(meta, {'content': '<h1 id="markdown">Markdown</h1>\n<p>Test</p>'})
+
     def test_pngparser(self):
         import PIL
         self.a.add_file_parser(appie.AppiePNGParser())
@@ -169,14 +194,20 @@ class AppieTest(unittest.TestCase):
         with open("./build/all.json") as f:
             j = json.load(f)
         self.zero_mtime(j)
-        self.assertEqual(j['img']['spacecat.png'], {
-                                        'md5': 'todo',
+        with open(os.path.join(self.sitesrc, 'img', 'spacecat.png'), 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        self.assertEqual(self.check_formats(j['img']['spacecat.png']), {
+                                        'md5': md5,
                                         'path': 'img',
                                         'mimetype': 'image/png',
                                         'mtime': 0,
                                         'size': [598, 335],
                                         'web': 'spacecat_web.jpg',
-                                        'thumb': 'spacecat_thumb.jpg'
+                                        'thumb': 'spacecat_thumb.jpg',
+                                        'renditions': [
+                                            {'name': 'web', 'file': 'spacecat_web.jpg', 'size': [598, 335]},
+                                            {'name': 'thumb', 'file': 'spacecat_thumb.jpg', 'size': [384, 215]}
+                                            ]
                                         })
         img = PIL.Image.open('./build/img/spacecat_web.jpg')
         # images should be less than or equal to specified size in parser 
@@ -201,14 +232,20 @@ class AppieTest(unittest.TestCase):
         # but first zero all mtime keys
         self.zero_mtime(j)
 
-        self.assertEqual(j['img']['spacecat.jpg'], {
-                                        'md5': 'todo',
+        with open(os.path.join(self.sitesrc, 'img', 'spacecat.jpg'), 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        self.assertEqual(self.check_formats(j['img']['spacecat.jpg']), {
+                                        'md5': md5,
                                         'path': 'img',
                                         'mtime': 0,
                                         'size': [1920,1080],
                                         'mimetype': 'image/jpg',
                                         'web': 'spacecat_web.jpg',
-                                        'thumb': 'spacecat_thumb.jpg'
+                                        'thumb': 'spacecat_thumb.jpg',
+                                        'renditions': [
+                                            {'name': 'web', 'file': 'spacecat_web.jpg', 'size': [1280, 720]},
+                                            {'name': 'thumb', 'file': 'spacecat_thumb.jpg', 'size': [384, 216]}
+                                            ]
                                         })
         img = PIL.Image.open('./build/img/spacecat_web.jpg')
         # images should be less than or equal to specified size in parser 
@@ -222,6 +259,728 @@ class AppieTest(unittest.TestCase):
         self.assertTrue(img.width <= 384)
         self.assertTrue(img.height <= 216)
 
+    def test_renditions(self):
+        import PIL
+        appie.config['renditions'] = [('640', (640, 640)), ('thumb', (100, 100)),
+                                      ('1280', (1280, 1280)), ('2560', (2560, 2560))]
+        try:
+            self.a.add_file_parser(appie.AppieJPGParser())
+        finally:
+            del appie.config['renditions']
+        self.a.parse()
+        with open("./build/all.json") as f:
+            j = json.load(f)
+        entry = self.check_formats(j['img']['spacecat.jpg'])
+        self.assertEqual(entry['renditions'], [
+                    {'name': '2560', 'file': 'spacecat_2560.jpg', 'size': [1920, 1080]},
+                    {'name': '1280', 'file': 'spacecat_1280.jpg', 'size': [1280, 720]},
+                    {'name': '640', 'file': 'spacecat_640.jpg', 'size': [640, 360]},
+                    {'name': 'thumb', 'file': 'spacecat_thumb.jpg', 'size': [100, 56]}
+                    ])
+        for r in entry['renditions']:
+            self.assertEqual(entry[r['name']], r['file'])
+            img = PIL.Image.open(os.path.join('./build/img', r['file']))
+            self.assertEqual(list(img.size), r['size'])
+
+    def test_passthrough(self):
+        import PIL.ImageFile
+        src = os.path.join(self.sitesrc, 'img', 'spacecat.jpg')
+        appie.config['renditions'] = [('full', (2560, 2560))]
+        try:
+            self.a.add_file_parser(appie.AppieJPGParser())
+        finally:
+            del appie.config['renditions']
+        # a JPG within the size of all renditions is not even decoded
+        load = PIL.ImageFile.ImageFile.load
+        def no_load(img):
+            raise AssertionError("image decoded")
+        PIL.ImageFile.ImageFile.load = no_load
+        try:
+            self.a.parse()
+        finally:
+            PIL.ImageFile.ImageFile.load = load
+        with open(src, 'rb') as f, open('./build/img/spacecat_full.jpg', 'rb') as out:
+            self.assertEqual(f.read(), out.read())
+        # only the renditions which don't fit or are of another format are encoded
+        appie.config['renditions'] = [('full', (2560, 2560)), ('thumb', (100, 100))]
+        appie.config['image_formats'] = ['jpg', 'webp']
+        try:
+            self.a.add_file_parser(appie.AppieJPGParser())
+        finally:
+            del appie.config['renditions']
+            del appie.config['image_formats']
+        self.a.parse()
+        with open("./build/all.json") as f:
+            full, thumb = json.load(f)['img']['spacecat.jpg']['renditions']
+        self.assertEqual(full['formats'][0]['bytes'], os.path.getsize(src))
+        self.assertEqual(PIL.Image.open('./build/img/spacecat_full.webp').size, (1920, 1080))
+        self.assertEqual(PIL.Image.open('./build/img/spacecat_thumb.jpg').size, (100, 56))
+        # copies are published like any other file
+        appie.config['renditions'] = [('full', (2560, 2560))]
+        appie.config['publish'] = 'hardlink'
+        tmp = tempfile.mkdtemp()
+        try:
+            appie.AppieJPGParser().parse_file(src, 'spacecat.jpg', tmp)
+            self.assertTrue(os.path.samefile(src, os.path.join(tmp, 'spacecat_full.jpg')))
+        finally:
+            del appie.config['renditions']
+            appie.config['publish'] = 'copy'
+            shutil.rmtree(tmp)
+
+    def test_webp(self):
+        import PIL
+        appie.config['image_formats'] = ['jpg', 'webp']
+        try:
+            self.a.add_file_parser(appie.AppiePNGParser())
+        finally:
+            del appie.config['image_formats']
+        self.a.parse()
+        with open("./build/all.json") as f:
+            entry = json.load(f)['img']['spacecat.png']
+        self.assertEqual(entry['web'], 'spacecat_web.jpg')
+        formats = entry['renditions'][0]['formats']
+        self.assertEqual([ (f['format'], f['file'], f['mimetype']) for f in formats ], [
+                    ('jpg', 'spacecat_web.jpg', 'image/jpeg'),
+                    ('webp', 'spacecat_web.webp', 'image/webp')])
+        self.assertEqual(formats[1]['bytes'], os.path.getsize('./build/img/spacecat_web.webp'))
+        img = PIL.Image.open('./build/img/spacecat_web.webp')
+        self.assertEqual(list(img.size), entry['renditions'][0]['size'])
+        rec = appie.Appie.cache.records[os.path.join(self.sitesrc, 'img', 'spacecat.png')]
+        self.assertIn('img/spacecat_thumb.webp', rec.outputs)
+        # lossless
+        appie.config['image_formats'] = ['webp']
+        appie.config['webp_lossless'] = True
+        try:
+            self.a.add_file_parser(appie.AppiePNGParser())
+        finally:
+            del appie.config['image_formats']
+            del appie.config['webp_lossless']
+        self.a.parse()
+        with open("./build/all.json") as f:
+            entry = json.load(f)['img']['spacecat.png']
+        self.assertEqual(entry['web'], 'spacecat_web.webp')
+        rec = appie.Appie.cache.records[os.path.join(self.sitesrc, 'img', 'spacecat.png')]
+        self.assertEqual(rec.outputs, ['img/spacecat_web.webp', 'img/spacecat_thumb.webp',
+                                       'img/spacecat.png'])
+        src = PIL.Image.open(os.path.join(self.sitesrc, 'img', 'spacecat.png'))
+        img = PIL.Image.open('./build/img/spacecat_web.webp')
+        self.assertEqual(list(img.convert('RGB').getdata()),
+                         list(src.convert('RGB').getdata()))
+
+    def test_webp_alpha(self):
+        import PIL
+        tmp = tempfile.mkdtemp()
+        try:
+            # a translucent PNG
+            img = PIL.Image.linear_gradient('L').resize((400, 300)).convert('RGB')
+            img.putalpha(PIL.Image.linear_gradient('L').resize((400, 300)))
+            img.save(os.path.join(tmp, 'alpha.png'))
+            appie.config['src'] = [tmp]
+            appie.config['image_formats'] = ['jpg', 'webp']
+            try:
+                self.a.add_file_parser(appie.AppiePNGParser())
+            finally:
+                del appie.config['image_formats']
+            self.a.parse()
+            # the alpha channel is kept in the WebP only
+            self.assertEqual(PIL.Image.open('./build/alpha_web.webp').mode, 'RGBA')
+            self.assertEqual(PIL.Image.open('./build/alpha_web.jpg').mode, 'RGB')
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_cache(self):
+        self.a.add_file_parser(appie.AppieJPGParser())
+        self.a.parse()
+        web = './build/img/spacecat_web.jpg'
+        os.utime(web, (0, 0))
+        # touch the source, its content is unchanged so no reparse
+        src = os.path.join(self.sitesrc, 'img', 'spacecat.jpg')
+        st = os.stat(src)
+        os.utime(src, (st.st_atime, st.st_mtime + 100))
+        try:
+            self.a.parse()
+        finally:
+            os.utime(src, (st.st_atime, st.st_mtime))
+        self.assertEqual(os.stat(web).st_mtime, 0)
+        with open("./build/all.json") as f:
+            j = json.load(f)
+        self.assertEqual(j['img']['spacecat.jpg']['mtime'], st.st_mtime + 100)
+        # other parser settings do invalidate the cache
+        self.a.add_file_parser(appie.AppieJPGParser())
+        appie.Appie.file_parsers[0].renditions = [('web', (100, 100))]
+        self.a.parse()
+        self.assertNotEqual(os.stat(web).st_mtime, 0)
+
+    def test_update(self):
+        tmp = tempfile.mkdtemp()
+        src = os.path.join(tmp, 'site_src')
+        shutil.copytree(self.sitesrc, src)
+        appie.config['src'] = [src]
+        self.a.add_file_parser(appie.AppieTextileParser())
+        try:
+            self.a.parse()
+            # change, add and remove some files
+            with open(os.path.join(src, 'home.textile'), 'w') as f:
+                f.write('h1. Changed')
+            os.makedirs(os.path.join(src, 'new', 'sub'))
+            with open(os.path.join(src, 'new', 'sub', 'new.textile'), 'w') as f:
+                f.write('h1. New')
+            os.remove(os.path.join(src, 'files', 'report2009.pdf'))
+            self.a.update([ os.path.join(src, 'home.textile'),
+                            os.path.join(src, 'new', 'sub', 'new.textile'),
+                            os.path.join(src, 'files', 'report2009.pdf') ])
+            with open("./build/all.json") as f:
+                updated = json.load(f)
+            self.assertEqual(updated['home.textile']['content'], '\t<h1>Changed</h1>')
+            # should be the same as a full parse
+            shutil.rmtree("./build")
+            self.a.parse()
+            with open("./build/all.json") as f:
+                full = json.load(f)
+            self.assertDictEqual(full, updated)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_update_cancelled(self):
+        tmp = tempfile.mkdtemp()
+        src = os.path.join(tmp, 'site_src')
+        shutil.copytree(self.sitesrc, src)
+        appie.config['src'] = [src]
+        self.a.add_file_parser(appie.AppieTextileParser())
+        try:
+            self.a.parse()
+            with open("./build/all.json") as f:
+                before = f.read()
+            paths = [ os.path.join(src, name) for name in ('home.textile', 'about.textile') ]
+            for path in paths:
+                with open(path, 'w') as f:
+                    f.write('h1. Changed')
+            # superseded after the first path, nothing is saved
+            remaining = self.a.update(paths, cancelled=lambda: True)
+            self.assertEqual(remaining, paths[1:])
+            with open("./build/all.json") as f:
+                self.assertEqual(before, f.read())
+            self.assertEqual(self.a.update(remaining), [])
+            with open("./build/all.json") as f:
+                j = json.load(f)
+            self.assertEqual(j['home.textile']['content'], '\t<h1>Changed</h1>')
+            self.assertEqual(j['about.textile']['content'], '\t<h1>Changed</h1>')
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_snapshot(self):
+        tmp = tempfile.mkdtemp()
+        src = os.path.join(tmp, 'site_src')
+        shutil.copytree(self.sitesrc, src)
+        appie.config['src'] = [src]
+        self.a.add_file_parser(appie.AppieTextileParser())
+        try:
+            self.a.parse()
+            snapshot = appie.Appie.cache.tree
+            self.assertIn(os.path.join(src, 'img'), snapshot.dirs())
+            self.assertIn(os.path.join(src, 'home.textile'), self.a.changes.added)
+            with open(os.path.join(src, 'home.textile'), 'w') as f:
+                f.write('h1. Changed')
+            with open(os.path.join(src, 'new.textile'), 'w') as f:
+                f.write('h1. New')
+            os.remove(os.path.join(src, 'files', 'report2009.pdf'))
+            self.a.parse()
+            changes = self.a.changes
+            self.assertEqual(changes.added, {os.path.join(src, 'new.textile')})
+            self.assertEqual(changes.removed, {os.path.join(src, 'files', 'report2009.pdf')})
+            self.assertIn(os.path.join(src, 'home.textile'), changes.modified)
+            self.assertIn(os.path.join(src, 'files'), changes.modified)
+            self.assertNotIn(os.path.join(src, 'about.textile'), changes.modified)
+            # the snapshot is saved with the build state
+            cache = appie.AppieBuildCache("./build/.appie_state")
+            cache.load()
+            self.assertEqual(cache.tree, appie.AppieSnapshot.scan([src]))
+            self.assertEqual(cache.tree.diff(appie.Appie.cache.tree),
+                             ( set(), set(), set() ))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_subtree(self):
+        tmp = tempfile.mkdtemp()
+        src = os.path.join(tmp, 'site_src')
+        shutil.copytree(self.sitesrc, src)
+        appie.config['src'] = [src]
+        self.a.add_file_parser(appie.AppieTextileParser())
+        self.a.add_file_parser(appie.AppieJPGParser())
+        try:
+            self.a.parse()
+            with open("./build/all.json") as f:
+                full = json.load(f)
+            # change a file outside of img, img is not checked at all
+            with open(os.path.join(src, 'home.textile'), 'w') as f:
+                f.write('h1. Changed')
+            is_modified = appie.AppieBuildCache.is_modified
+            checked = []
+            def check(cache, path, st, parser):
+                checked.append(path)
+                return is_modified(cache, path, st, parser)
+            appie.AppieBuildCache.is_modified = check
+            try:
+                self.a.parse()
+            finally:
+                appie.AppieBuildCache.is_modified = is_modified
+            self.assertIn(os.path.join(src, 'home.textile'), checked)
+            self.assertFalse([ p for p in checked if os.sep + 'img' + os.sep in p ])
+            # its files are kept in the build state and the build
+            jpg = os.path.join(src, 'img', 'spacecat.jpg')
+            self.assertIn(jpg, appie.Appie.cache.records)
+            self.assertTrue(os.path.isfile("./build/img/spacecat_web.jpg"))
+            with open("./build/all.json") as f:
+                j = json.load(f)
+            self.assertEqual(j['home.textile']['content'], '\t<h1>Changed</h1>')
+            self.assertDictEqual(full['img'], j['img'])
+            # a change deep in a subtree is found
+            os.remove(os.path.join(src, 'img', 'img', 'spacecat.png'))
+            self.a.parse()
+            with open("./build/all.json") as f:
+                j = json.load(f)
+            self.assertFalse(j['img'].get('img'))
+            self.assertIn(jpg, appie.Appie.cache.records)
+            # should be the same as a full parse
+            shutil.rmtree("./build")
+            self.a.parse()
+            with open("./build/all.json") as f:
+                self.assertDictEqual(json.load(f), j)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_compress(self):
+        tmp = tempfile.mkdtemp()
+        src = os.path.join(tmp, 'site_src')
+        shutil.copytree(self.sitesrc, src)
+        with open(os.path.join(src, 'style.css'), 'w') as f:
+            f.write("body { color: black; }\n" * 100)
+        appie.config['src'] = [src]
+        appie.config['compress'] = True
+        try:
+            self.a.parse()
+            for name in ('all.json', 'style.css'):
+                path = os.path.join("./build", name)
+                with open(path, 'rb') as f, gzip.open(path + '.gz') as gz:
+                    self.assertEqual(f.read(), gz.read())
+                self.assertEqual(os.stat(path).st_mtime_ns,
+                                 os.stat(path + '.gz').st_mtime_ns)
+            # too small to compress
+            self.assertFalse(os.path.exists("./build/blog.md.html.gz"))
+            # only changed files are compressed again
+            css = os.stat("./build/style.css.gz").st_ino
+            with open(os.path.join(src, 'home.textile'), 'w') as f:
+                f.write('h1. Changed')
+            self.a.parse()
+            self.assertEqual(css, os.stat("./build/style.css.gz").st_ino)
+            with open("./build/all.json", 'rb') as f, gzip.open("./build/all.json.gz") as gz:
+                self.assertEqual(f.read(), gz.read())
+            # sidecars of removed files are removed
+            os.remove(os.path.join(src, 'style.css'))
+            self.a.parse()
+            self.assertFalse(os.path.exists("./build/style.css"))
+            self.assertFalse(os.path.exists("./build/style.css.gz"))
+            # compressing uses all cores, whatever the number of jobs
+            module = sys.modules['appie.appie']
+            calls = []
+            compress = module.compress_output
+            module.compress_output = lambda *args: calls.append(args) or 0
+            try:
+                self.a.compress_output()
+            finally:
+                module.compress_output = compress
+            self.assertIsNone(calls[0][2])
+        finally:
+            appie.config['compress'] = False
+            shutil.rmtree(tmp)
+
+    def test_compress_update(self):
+        tmp = tempfile.mkdtemp()
+        src = os.path.join(tmp, 'site_src')
+        shutil.copytree(self.sitesrc, src)
+        css = os.path.join(src, 'style.css')
+        with open(css, 'w') as f:
+            f.write("body { color: black; }\n" * 100)
+        appie.config['src'] = [src]
+        appie.config['compress'] = True
+        self.a.add_file_parser(appie.AppieTextileParser())
+        walk = appie.compress.os.walk
+        try:
+            self.a.parse()
+            # an update only looks at what it wrote, not the whole buildroot
+            def no_walk(*args):
+                raise AssertionError("buildroot walked")
+            appie.compress.os.walk = no_walk
+            with open(css, 'w') as f:
+                f.write("body { color: white; }\n" * 100)
+            with open(os.path.join(src, 'home.textile'), 'w') as f:
+                f.write('h1. Changed')
+            self.a.update([css, os.path.join(src, 'home.textile')])
+            for name in ('all.json', 'style.css'):
+                path = os.path.join("./build", name)
+                with open(path, 'rb') as f, gzip.open(path + '.gz') as gz:
+                    self.assertEqual(f.read(), gz.read())
+            os.remove(css)
+            self.a.update([css])
+            self.assertFalse(os.path.exists("./build/style.css.gz"))
+            self.assertNotIn('style.css', appie.Appie.cache.sidecars)
+        finally:
+            appie.compress.os.walk = walk
+            appie.config['compress'] = False
+            shutil.rmtree(tmp)
+
+    def test_noop(self):
+        self.a.add_file_parser(appie.AppieJPGParser())
+        self.a.parse()
+        self.assertTrue(os.path.isfile("./build/.appie_state"))
+        rec = appie.Appie.cache.records[os.path.join(self.sitesrc, 'img', 'spacecat.jpg')]
+        self.assertEqual(rec.outputs, ['img/spacecat_web.jpg', 'img/spacecat_thumb.jpg', 'img/spacecat.jpg'])
+        # nothing changed so the previous output is not even loaded
+        def load_output():
+            raise AssertionError("previous output loaded")
+        self.a.load_output = load_output
+        self.a.parse()
+        # a touched file does need the previous output
+        del self.a.load_output
+        src = os.path.join(self.sitesrc, '_test')
+        st = os.stat(src)
+        os.utime(src, (st.st_atime, st.st_mtime + 100))
+        try:
+            self.a.load_output = load_output
+            self.assertRaises(AssertionError, self.a.parse)
+        finally:
+            os.utime(src, (st.st_atime, st.st_mtime))
+
+    def test_publish(self):
+        src = os.path.join(self.sitesrc, 'files', 'report2008.pdf')
+        dest = "./build/files/report2008.pdf"
+        for method in ('copy', 'changed', 'hardlink', 'reflink', 'symlink'):
+            appie.config['publish'] = method
+            try:
+                self.a.parse()
+            finally:
+                appie.config['publish'] = 'copy'
+            with open(src, 'rb') as f1, open(dest, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(os.path.islink(dest), method == 'symlink')
+            self.assertEqual(os.path.samefile(src, dest), method in ('hardlink', 'symlink'))
+        # only copies changed files
+        appie.publish_file(src, "./build/files", 'copy')
+        os.utime(dest, (0, 0))
+        appie.publish_file(src, "./build/files", 'changed')
+        self.assertEqual(os.stat(dest).st_mtime, 0)
+
+    def test_shards(self):
+        self.a.add_file_parser(appie.AppieTextileParser())
+        self.a.parse()
+        with open("./build/all.json") as f:
+            full = json.load(f)
+        shutil.rmtree("./build")
+        appie.config['output'] = 'shards'
+        try:
+            self.a.parse()
+            with open("./build/.appie_shards/manifest.json") as f:
+                manifest = json.load(f)
+            self.assertEqual(set(manifest), {'', 'files', 'img', 'img/img'})
+            self.assertFalse(os.path.exists("./build/all.json"))
+            with open("./build/.appie_shards/img/index.json") as f:
+                shard = json.load(f)
+            self.assertEqual(shard['img']['shard'], '.appie_shards/img/img/index.json')
+            self.assertNotIn('spacecat.png', shard['img'])
+            # all shards together are the full dictionary
+            self.assertDictEqual(full, self.a.load_shards("./build"))
+            # unchanged shards are not written again
+            os.utime("./build/.appie_shards/img/index.json", (0, 0))
+            self.a.parse()
+            self.assertEqual(os.stat("./build/.appie_shards/img/index.json").st_mtime, 0)
+            # the layout does not depend on the directories in the buildroot
+            shutil.rmtree("./build/files")
+            self.a.save_shards(self.a.load_shards("./build"), "./build")
+            with open("./build/.appie_shards/manifest.json") as f:
+                self.assertIn('files', json.load(f))
+            # limit the depth
+            appie.config['shard_depth'] = 1
+            self.a.parse()
+            with open("./build/.appie_shards/manifest.json") as f:
+                manifest = json.load(f)
+            self.assertEqual(set(manifest), {'', 'files', 'img'})
+            self.assertFalse(os.path.exists("./build/.appie_shards/img/img/index.json"))
+            self.assertDictEqual(full, self.a.load_shards("./build"))
+        finally:
+            appie.config['output'] = 'json'
+            appie.config['shard_depth'] = None
+
+    def test_shards_reserved(self):
+        tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmp, 'shards'))
+        for name in ('manifest.json', os.path.join('shards', 'index.json')):
+            with open(os.path.join(tmp, name), 'w') as f:
+                f.write('{"site": true}')
+        appie.config['src'] = [tmp]
+        appie.config['output'] = 'shards'
+        try:
+            self.a.parse()
+            # the files of the site are not overwritten by the shards
+            for name in ('manifest.json', os.path.join('shards', 'index.json')):
+                with open(os.path.join("./build", name)) as f:
+                    self.assertEqual(json.load(f), {'site': True})
+            os.remove(os.path.join(tmp, 'shards', 'index.json'))
+            self.a.parse()
+            self.assertFalse(os.path.exists("./build/shards/index.json"))
+            self.assertIn('manifest.json', self.a.load_shards("./build"))
+        finally:
+            appie.config['output'] = 'json'
+            shutil.rmtree(tmp)
+
+    def test_stream(self):
+        self.a.add_file_parser(appie.AppieTextileParser())
+        self.a.parse()
+        with open("./build/all.json") as f:
+            full = json.load(f)
+        shutil.rmtree("./build")
+        appie.config['stream'] = True
+        try:
+            self.a.parse()
+            with open("./build/all.json") as f:
+                self.assertDictEqual(full, json.load(f))
+            self.assertTrue(os.path.isfile("./build/.appie_index.json"))
+            # the next run reads unchanged entries from the streamed all.json
+            prev = self.a.open_stream()
+            self.assertIsInstance(prev, appie.AppieLazyDict)
+            self.assertEqual(prev['img'].get('spacecat.png'), full['img']['spacecat.png'])
+            prev.f.close()
+            appie.config['jobs'] = 2
+            self.a.parse()
+            with open("./build/all.json") as f:
+                self.assertDictEqual(full, json.load(f))
+        finally:
+            appie.config['stream'] = False
+            appie.config['jobs'] = 1
+
+    def test_parallel(self):
+        self.a.add_file_parser(appie.AppieTextileParser())
+        # serial run
+        self.a.parse()
+        with open("./build/all.json") as f:
+            serial = json.load(f)
+        shutil.rmtree("./build")
+        # parallel run should result in the same dictionary
+        appie.config['jobs'] = 2
+        try:
+            self.a.parse()
+        finally:
+            appie.config['jobs'] = 1
+        with open("./build/all.json") as f:
+            parallel = json.load(f)
+        self.assertDictEqual(serial, parallel)
+        self.assertTrue(os.path.isfile("./build/files/report2008.pdf"))
+        self.assertIsNone(appie.Appie.executor)
+
+    def test_async(self):
+        self.a.add_file_parser(appie.AppieTextileParser())
+        self.a.add_file_parser(appie.AppieJPGParser())
+        self.a.parse()
+        with open("./build/all.json") as f:
+            serial = json.load(f)
+        try:
+            for jobs in (1, 2):
+                shutil.rmtree("./build")
+                appie.config['async'] = True
+                appie.config['io_limit'] = 4
+                appie.config['jobs'] = jobs
+                self.a.parse()
+                with open("./build/all.json") as f:
+                    self.assertDictEqual(serial, json.load(f))
+                self.assertTrue(os.path.isfile("./build/img/spacecat_web.jpg"))
+            # unchanged files are reused
+            os.utime(os.path.join(self.sitesrc, "about.textile"))
+            self.a.parse()
+            with open("./build/all.json") as f:
+                self.assertDictEqual(serial['files'], json.load(f)['files'])
+        finally:
+            appie.config['async'] = False
+            appie.config['io_limit'] = 32
+            appie.config['jobs'] = 1
+        self.assertIsNone(appie.Appie.io_executor)
+
+    def test_profile(self):
+        self.a.add_file_parser(appie.AppieJPGParser())
+        self.a.add_file_parser(appie.AppieTextileParser())
+        appie.config['profile'] = True
+        try:
+            self.a.parse()
+            profiler = appie.Appie.profiler
+            parsers = profiler.parsers()
+            self.assertEqual(parsers['AppieJPGParser']['miss'], 1)
+            self.assertEqual(parsers['AppieTextileParser']['miss'], 2)
+            self.assertIn('publish', parsers['AppieFileParser']['steps'])
+            self.assertEqual([ p['name'] for p in profiler.phases ],
+                    ['scan', 'load previous', 'parse', 'save output', 'save state'])
+            self.assertIn("AppieJPGParser", profiler.report(3))
+            # touched files are cache hits
+            os.utime(os.path.join(self.sitesrc, "home.textile"))
+            self.a.parse()
+            parsers = appie.Appie.profiler.parsers()
+            self.assertEqual(parsers['AppieTextileParser']['hit'], 2)
+            # unchanged directories are reused as a whole
+            self.assertNotIn('AppieJPGParser', parsers)
+            self.assertGreaterEqual(parsers['AppieDirParser']['hit'], 1)
+            appie.Appie.profiler.save("./build/profile.json", 'trace')
+            with open("./build/profile.json") as f:
+                events = json.load(f)['traceEvents']
+            self.assertTrue(all(e['ph'] == 'X' for e in events))
+        finally:
+            appie.config['profile'] = False
+
+    def test_profile_thread(self):
+        # the work of other threads is not counted
+        sample = appie.AppieSample('busy', 'test')
+        busy = threading.Thread(target=lambda: sum(range(10 ** 7)))
+        busy.start()
+        busy.join()
+        self.assertLess(sample.stop()['cpu'], 0.05)
+
+    def test_links(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, 'src')
+            shutil.copytree(self.sitesrc, src)
+            with open(os.path.join(src, 'files', 'links.textile'), 'w') as f:
+                f.write('"home":../home.textile "gone":missing.pdf '
+                        '"ext":http://example.com "anchor":#top\n\n'
+                        '!/img/spacecat.jpg!')
+            appie.config['src'] = [src]
+            self.a.add_file_parser(appie.AppieTextileParser())
+            self.a.parse()
+            about = os.path.join(src, 'about.textile')
+            links = os.path.join(src, 'files', 'links.textile')
+            self.assertEqual(appie.Appie.cache.records[about].refs, ['img/spacecat.jpg'])
+            self.assertEqual(appie.Appie.cache.records[links].refs,
+                             ['home.textile', 'files/missing.pdf', 'img/spacecat.jpg'])
+            self.assertEqual(self.a.broken_links(), [(links, 'files/missing.pdf')])
+            # the files linking to an image
+            image = os.path.join(src, 'img', 'spacecat.jpg')
+            self.assertEqual(appie.Appie.cache.dependents(image), [about, links])
+            # removing it warns about the files linking to it
+            os.remove(image)
+            with self.assertLogs('appie.appie', 'WARNING') as logs:
+                self.a.update([image])
+            self.assertEqual(len(logs.output), 2)
+            self.assertNotIn(image, appie.Appie.cache.records)
+            # lazy loading placeholders are no links
+            self.assertEqual(appie.html_links('<img data-src="lazy.jpg"\nsrc="a.jpg">'),
+                             ['a.jpg'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_prune(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, 'src')
+            shutil.copytree(self.sitesrc, src)
+            appie.config['src'] = [src]
+            self.a.add_file_parser(appie.AppieJPGParser())
+            self.a.parse()
+            self.assertTrue(os.path.isfile("./build/img/spacecat_web.jpg"))
+            self.assertTrue(os.path.isfile("./build/files/report2008.pdf"))
+            # removed files and directories are removed from the build
+            os.remove(os.path.join(src, 'img', 'spacecat.jpg'))
+            os.remove(os.path.join(src, 'img', 'spacecat.png'))
+            shutil.rmtree(os.path.join(src, 'files'))
+            self.a.parse()
+            self.assertFalse(os.path.exists("./build/img/spacecat_web.jpg"))
+            self.assertFalse(os.path.exists("./build/img/spacecat_thumb.jpg"))
+            self.assertFalse(os.path.exists("./build/img/spacecat.jpg"))
+            self.assertFalse(os.path.exists("./build/img/spacecat.png"))
+            self.assertTrue(os.path.isfile("./build/img/img/spacecat.png"))
+            self.assertFalse(os.path.exists("./build/files"))
+            # the same for incremental updates
+            png = os.path.join(src, 'img', 'img', 'spacecat.png')
+            os.remove(png)
+            self.a.update([png])
+            self.assertFalse(os.path.exists("./build/img/img"))
+            self.assertNotIn('spacecat.png', self.a.tree['img']['img'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_move(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, 'src')
+            shutil.copytree(self.sitesrc, src)
+            appie.config['src'] = [src]
+            self.a.add_file_parser(appie.AppieJPGParser())
+            self.a.add_file_parser(appie.AppieTextileParser())
+            self.a.parse()
+            # a renamed file is moved
+            old = os.path.join(src, 'files', 'report2008.pdf')
+            new = os.path.join(src, 'files', 'report2007.pdf')
+            os.rename(old, new)
+            with open("./build/files/report2008.pdf", 'rb') as f:
+                data = f.read()
+            self.assertTrue(self.a._move(old, new))
+            self.assertFalse(os.path.exists("./build/files/report2008.pdf"))
+            with open("./build/files/report2007.pdf", 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertIn('report2007.pdf', self.a.tree['files'])
+            self.assertNotIn('report2008.pdf', self.a.tree['files'])
+            self.assertEqual(appie.Appie.cache.records[new].outputs, ['files/report2007.pdf'])
+            # a renamed directory is moved with everything in it
+            old, new = os.path.join(src, 'files'), os.path.join(src, 'docs')
+            os.rename(old, new)
+            self.a.update([], [(old, new)])
+            self.assertTrue(os.path.isfile("./build/docs/report2007.pdf"))
+            self.assertFalse(os.path.exists("./build/files"))
+            self.assertEqual(self.a.tree['docs']['report2009.pdf']['path'], 'docs')
+            self.assertEqual(self.a.tree['docs']['path'], '')
+            # renditions are named after the file so the image is parsed
+            old = os.path.join(src, 'img', 'spacecat.jpg')
+            new = os.path.join(src, 'img', 'cat.jpg')
+            os.rename(old, new)
+            self.assertFalse(self.a._move(old, new))
+            self.a.update([], [(old, new)])
+            self.assertTrue(os.path.isfile("./build/img/cat_web.jpg"))
+            self.assertFalse(os.path.exists("./build/img/spacecat_web.jpg"))
+            self.assertEqual(self.a.tree['img']['cat.jpg']['web'], 'cat_web.jpg')
+            # the result is the same as a full parse
+            with open("./build/all.json") as f:
+                updated = json.load(f)
+            self.a.parse()
+            with open("./build/all.json") as f:
+                self.assertEqual(json.load(f), updated)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_parser_index(self):
+        class HTMLParser(appie.AppieFileParser):
+            match_suffixes = ('.html',)
+
+        class DraftParser(appie.AppieFileParser):
+            def match(self, name):
+                return 'draft' in name
+
+        md = appie.AppieMarkdownParser()
+        mdfile = appie.AppieMarkdownToFileParser()
+        html = HTMLParser()
+        draft = DraftParser()
+        default = appie.AppieFileParser()
+        # highest priority first, like Appie.file_parsers
+        index = appie.AppieParserIndex([mdfile, draft, html, md], default)
+        self.assertIs(index.match("page.md"), md)
+        self.assertIs(index.match("page.html"), html)
+        self.assertIs(index.match("page.md.html"), mdfile)
+        self.assertIs(index.match("draft.md.html"), mdfile)
+        self.assertIs(index.match("draft.html"), draft)
+        self.assertIs(index.match("_test"), default)
+        self.assertIs(index.match("report.pdf"), default)
+        # the result is the same as testing every parser in order
+        for name in ("page.md", "draft.md", "draft.md.html", "x.html", "md"):
+            expected = next((p for p in index.parsers if p.match(name)), default)
+            self.assertIs(index.match(name), expected)
+        # defaults are reused
+        self.assertIs(appie.Appie.match_dir_parsers("nomatch"),
+                      appie.Appie.match_dir_parsers("nomatch2"))
+
 
 class AppieMultiTest(unittest.TestCase):
 
@@ -303,6 +1062,115 @@ class AppieMultiTest(unittest.TestCase):
                         }
         self.assertDictEqual(jstruct, j)
 
+    def test_overlay(self):
+        tmp = tempfile.mkdtemp()
+        theme, content = os.path.join(tmp, 'theme'), os.path.join(tmp, 'content')
+        jpg = os.path.join("./tests/site_src", 'img', 'spacecat.jpg')
+        for src in (theme, content):
+            os.makedirs(os.path.join(src, 'img'))
+            shutil.copy(jpg, os.path.join(src, 'img', 'logo.jpg'))
+            with open(os.path.join(src, 'home.textile'), 'w') as f:
+                f.write('h1. ' + os.path.basename(src))
+        shutil.copy(jpg, os.path.join(theme, 'img', 'bg.jpg'))
+        appie.config['src'] = [theme, content]
+        self.a.add_file_parser(appie.AppieTextileParser())
+        self.a.add_file_parser(appie.AppieJPGParser())
+        submit = appie.Appie.__dict__['submit']
+        parsed = []
+        def count(fn, parser, path, *args):
+            parsed.append(path)
+            return submit.__func__(fn, parser, path, *args)
+        appie.Appie.submit = staticmethod(count)
+        try:
+            self.a.parse()
+            # overridden files are not parsed
+            self.assertEqual(sorted(parsed), sorted([
+                os.path.join(content, 'home.textile'),
+                os.path.join(content, 'img', 'logo.jpg'),
+                os.path.join(theme, 'img', 'bg.jpg') ]))
+            with open("./build/all.json") as f:
+                j = json.load(f)
+            self.assertEqual(j['home.textile']['content'], '\t<h1>content</h1>')
+            self.assertEqual(sorted(j['img']), ['bg.jpg', 'logo.jpg', 'mtime', 'path'])
+            self.assertNotIn(os.path.join(theme, 'img', 'logo.jpg'), appie.Appie.cache.records)
+            # removing the override falls back to the theme
+            os.remove(os.path.join(content, 'home.textile'))
+            self.a.update([os.path.join(content, 'home.textile')])
+            with open("./build/all.json") as f:
+                updated = json.load(f)
+            self.assertEqual(updated['home.textile']['content'], '\t<h1>theme</h1>')
+            shutil.rmtree("./build")
+            self.a.parse()
+            with open("./build/all.json") as f:
+                self.assertDictEqual(json.load(f), updated)
+        finally:
+            appie.Appie.submit = submit
+            shutil.rmtree(tmp)
+
+    def test_overlay_links(self):
+        tmp = tempfile.mkdtemp()
+        theme, content = os.path.join(tmp, 'theme'), os.path.join(tmp, 'content')
+        for src in (theme, content):
+            os.makedirs(src)
+            with open(os.path.join(src, 'style.css'), 'w') as f:
+                f.write(os.path.basename(src))
+        with open(os.path.join(theme, 'home.textile'), 'w') as f:
+            f.write('"style":style.css')
+        appie.config['src'] = [theme, content]
+        self.a.add_file_parser(appie.AppieTextileParser())
+        try:
+            self.a.parse()
+            # the theme's style.css still serves the link
+            os.remove(os.path.join(content, 'style.css'))
+            with self.assertNoLogs('appie.appie', 'WARNING'):
+                self.a.update([os.path.join(content, 'style.css')])
+            with open("./build/style.css") as f:
+                self.assertEqual(f.read(), 'theme')
+            os.remove(os.path.join(theme, 'style.css'))
+            with self.assertLogs('appie.appie', 'WARNING'):
+                self.a.update([os.path.join(theme, 'style.css')])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_overlay_update(self):
+        tmp = tempfile.mkdtemp()
+        theme, content = os.path.join(tmp, 'theme'), os.path.join(tmp, 'content')
+        for src in (theme, content):
+            os.makedirs(src)
+            with open(os.path.join(src, 'style.css'), 'w') as f:
+                f.write(os.path.basename(src))
+        with open(os.path.join(theme, 'home.textile'), 'w') as f:
+            f.write('h1. theme')
+        os.remove(os.path.join(content, 'style.css'))
+        appie.config['src'] = [theme, content]
+        self.a.add_file_parser(appie.AppieTextileParser())
+        try:
+            self.a.parse()
+            # overrides added and removed in watch mode
+            override = os.path.join(content, 'home.textile')
+            with open(override, 'w') as f:
+                f.write('h1. content')
+            with open(os.path.join(content, 'style.css'), 'w') as f:
+                f.write('content')
+            self.a.update([override, os.path.join(content, 'style.css')])
+            with open("./build/style.css") as f:
+                self.assertEqual(f.read(), 'content')
+            with open("./build/all.json") as f:
+                self.assertEqual(json.load(f)['home.textile']['content'], '\t<h1>content</h1>')
+            os.remove(override)
+            os.remove(os.path.join(content, 'style.css'))
+            self.a.update([override, os.path.join(content, 'style.css')])
+            with open("./build/all.json") as f:
+                self.assertEqual(json.load(f)['home.textile']['content'], '\t<h1>theme</h1>')
+            with open("./build/style.css") as f:
+                self.assertEqual(f.read(), 'theme')
+            self.a.parse()
+            with open("./build/all.json") as f:
+                self.assertEqual(json.load(f)['home.textile']['content'], '\t<h1>theme</h1>')
+            with open("./build/style.css") as f:
+                self.assertEqual(f.read(), 'theme')
+        finally:
+            shutil.rmtree(tmp)
 
 import logging
 if __name__ == '__main__':
@@ -3,6 +3,7 @@ import unittest
 import shutil
 import os
 import json
+import tempfile
 import appie
 import appie.extensions
 
@@ -42,6 +43,17 @@ class BlogTest(unittest.TestCase):
                             'summary': ['A brief description of my document.'],
                             'tags': ['tag1', 'tag2'],
                             'title': ['First Post']},
+          'index.html': {'mtime': 0, 'page': 1, 'pages': 1, 'path': 'blog',
+                         'posts': ['first_post.html']},
+          'page1.html': {'mtime': 0, 'page': 1, 'pages': 1, 'path': 'blog',
+                         'posts': ['first_post.html']},
+          'atom.xml': {'mtime': 0, 'path': 'blog', 'posts': ['first_post.html']},
+          'tags': {'mtime': 0,
+                   'path': 'blog',
+                   'tag1.html': {'mtime': 0, 'path': 'blog/tags', 'tag': 'tag1',
+                                 'posts': ['first_post.html']},
+                   'tag2.html': {'mtime': 0, 'path': 'blog/tags', 'tag': 'tag2',
+                                 'posts': ['first_post.html']}},
           'mtime': 0,
           'path': ''}}
 
@@ -66,6 +78,170 @@ class BlogTest(unittest.TestCase):
         #pprint.pprint(j)
         self.assertDictEqual(jstruct, j)
 
+    def test_async(self):
+        self.a.add_directory_parser( appie.AppieBlogDirParser() )
+        self.a.add_file_parser( appie.AppieMarkdownParser() )
+        self.a.parse()
+        with open("./build/all.json") as f:
+            serial = json.load(f)
+        self.zero_mtime(serial)
+        shutil.rmtree("./build")
+        appie.config['async'] = True
+        try:
+            self.a.parse()
+        finally:
+            appie.config['async'] = False
+        with open("./build/all.json") as f:
+            j = json.load(f)
+        self.zero_mtime(j)
+        self.assertDictEqual(serial, j)
+        self.assertTrue(os.path.isfile("./build/blog/first_post.html"))
+        shutil.rmtree("./build")
+
+    def test_url(self):
+        self.a.add_directory_parser( appie.AppieBlogDirParser() )
+        self.a.add_file_parser( appie.AppieMarkdownParser() )
+        try:
+            self.a.parse()
+            # only the base url of the feed changes
+            appie.config['url'] = 'http://example.com'
+            self.a.parse()
+            with open("./build/blog/atom.xml") as f:
+                self.assertIn("http://example.com/blog/", f.read())
+        finally:
+            appie.config['url'] = ''
+            shutil.rmtree("./build", ignore_errors=True)
+
+    def test_profile(self):
+        self.a.add_directory_parser( appie.AppieBlogDirParser() )
+        self.a.add_file_parser( appie.AppieMarkdownParser() )
+        appie.config['profile'] = True
+        try:
+            self.a.parse()
+            # the posts and the listings are sampled
+            blog = appie.Appie.profiler.parsers()['AppieBlogDirParser']
+            self.assertEqual(blog['miss'], 2)
+            self.assertEqual(set(blog['steps']), {'parse', 'render'})
+            names = [ s['name'] for s in appie.Appie.profiler.samples ]
+            self.assertIn(os.path.join(self.sitesrc, 'blog', 'first_post.md'), names)
+        finally:
+            appie.config['profile'] = False
+            shutil.rmtree("./build", ignore_errors=True)
+
+    def test_templates(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            blog = os.path.join(tmp, 'blog')
+            shutil.copytree(os.path.join(self.sitesrc, 'blog'), blog)
+            with open(os.path.join(blog, 'base.jinja2'), 'w') as f:
+                f.write("<title>{% block title %}{% endblock %}</title>")
+            with open(os.path.join(blog, 'other.jinja2'), 'w') as f:
+                f.write("{% extends 'base.jinja2' %}"
+                        "{% block title %}{{ title[0] }}{% endblock %}")
+            with open(os.path.join(blog, 'second_post.md'), 'w') as f:
+                f.write("title: Second Post\ntemplate: other.jinja2\n\nHello")
+            appie.config['src'] = [tmp]
+            self.a.add_directory_parser( appie.AppieBlogDirParser() )
+            self.a.add_file_parser( appie.AppieMarkdownParser() )
+            self.a.parse()
+            with open("./build/blog/second_post.html") as f:
+                self.assertEqual(f.read(), "<title>Second Post</title>")
+            self.assertTrue(os.path.isdir("./build/.appie_jinja"))
+            first = os.stat("./build/blog/first_post.html").st_mtime_ns
+            second = os.stat("./build/blog/second_post.html").st_mtime_ns
+            # a change of a base template only renders the posts using it
+            with open(os.path.join(blog, 'base.jinja2'), 'w') as f:
+                f.write("<h1>{% block title %}{% endblock %}</h1>")
+            self.a.parse()
+            with open("./build/blog/second_post.html") as f:
+                self.assertEqual(f.read(), "<h1>Second Post</h1>")
+            self.assertEqual(first, os.stat("./build/blog/first_post.html").st_mtime_ns)
+            self.assertNotEqual(second, os.stat("./build/blog/second_post.html").st_mtime_ns)
+        finally:
+            shutil.rmtree(tmp)
+            shutil.rmtree("./build", ignore_errors=True)
+
+    def test_listing_clash(self):
+        tmp = tempfile.mkdtemp()
+        self.a.add_directory_parser( appie.AppieBlogDirParser() )
+        self.a.add_file_parser( appie.AppieMarkdownParser() )
+        try:
+            blog = os.path.join(tmp, 'blog')
+            shutil.copytree(os.path.join(self.sitesrc, 'blog'), blog)
+            appie.config['src'] = [tmp]
+            # a post would be overwritten by a listing page
+            for name in ('index.md', 'page2.md'):
+                with open(os.path.join(blog, name), 'w') as f:
+                    f.write("title: Clash\n\nHello")
+                with self.assertRaises(ValueError):
+                    self.a.parse()
+                os.remove(os.path.join(blog, name))
+            self.a.parse()
+            self.assertTrue(os.path.isfile("./build/blog/index.html"))
+        finally:
+            shutil.rmtree(tmp)
+            shutil.rmtree("./build", ignore_errors=True)
+
+    def test_listings(self):
+        tmp = tempfile.mkdtemp()
+        self.a.add_directory_parser( appie.AppieBlogDirParser() )
+        self.a.add_file_parser( appie.AppieMarkdownParser() )
+        page_size = appie.AppieBlogDirParser.page_size
+        appie.AppieBlogDirParser.page_size = 2
+        try:
+            blog = os.path.join(tmp, 'blog')
+            shutil.copytree(os.path.join(self.sitesrc, 'blog'), blog)
+            def post(n, tags):
+                with open(os.path.join(blog, 'post{0}.md'.format(n)), 'w') as f:
+                    f.write("title: Post {0}\nsummary: Post {0}\ndate: 2017-01-{0:02d}\n"
+                            "tags: {1}\n\nHello".format(n, tags))
+            for n in range(1, 5):
+                post(n, 'even' if n % 2 == 0 else 'odd')
+            appie.config['src'] = [tmp]
+            self.a.parse()
+            with open("./build/all.json") as f:
+                j = json.load(f)['blog']
+            # oldest first: first_post (2016), post1, post2, post3, post4
+            self.assertEqual(j['page1.html']['posts'], ['post1.html', 'first_post.html'])
+            self.assertEqual(j['page3.html']['posts'], ['post4.html'])
+            self.assertEqual(j['index.html']['posts'], ['post4.html'])
+            self.assertEqual(j['tags']['even.html']['posts'], ['post4.html', 'post2.html'])
+            self.assertEqual(j['atom.xml']['posts'][0], 'post4.html')
+            with open("./build/blog/atom.xml") as f:
+                self.assertIn("<title>Post 4</title>", f.read())
+            mtimes = { name: os.stat(os.path.join("./build/blog", name)).st_mtime_ns
+                       for name in ('page1.html', 'page2.html', 'page3.html',
+                                    'tags/odd.html', 'tags/even.html') }
+            # a new post only changes the last page, its tag and the feed
+            post(5, 'odd')
+            self.a.parse()
+            with open("./build/all.json") as f:
+                j = json.load(f)['blog']
+            self.assertEqual(j['page3.html']['posts'], ['post5.html', 'post4.html'])
+            for name in ('page1.html', 'page2.html', 'tags/even.html'):
+                self.assertEqual(mtimes[name], os.stat(os.path.join("./build/blog", name)).st_mtime_ns)
+            for name in ('page3.html', 'tags/odd.html'):
+                self.assertNotEqual(mtimes[name], os.stat(os.path.join("./build/blog", name)).st_mtime_ns)
+            # tags with the same slug get their own page
+            post(6, 'a b\n      a-b')
+            self.a.parse()
+            with open("./build/all.json") as f:
+                tags = json.load(f)['blog']['tags']
+            self.assertEqual(tags['a-b.html']['tag'], 'a b')
+            self.assertEqual(tags['a-b-2.html']['tag'], 'a-b')
+            os.remove(os.path.join(blog, 'post6.md'))
+            # removed tags and pages are removed
+            os.remove(os.path.join(blog, 'post5.md'))
+            os.remove(os.path.join(blog, 'post4.md'))
+            os.remove(os.path.join(blog, 'post2.md'))
+            self.a.parse()
+            self.assertFalse(os.path.exists("./build/blog/page3.html"))
+            self.assertFalse(os.path.exists("./build/blog/tags/even.html"))
+        finally:
+            appie.AppieBlogDirParser.page_size = page_size
+            shutil.rmtree(tmp)
+            shutil.rmtree("./build", ignore_errors=True)
+
 import logging
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,174 @@
+import unittest
+import shutil
+import os
+import gzip
+import time
+import threading
+import http.client
+import appie
+from appie.server import AppieHTTPServer, AppieRebuildScheduler
+
+
+class AppieServerTest(unittest.TestCase):
+
+    def setUp(self):
+        appie.config['src'] = "./tests/site_src"
+        appie.Appie().parse()
+        self.httpd = AppieHTTPServer(("127.0.0.1", 0), appie.config['target'])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        try:
+            shutil.rmtree("./build")
+        except FileNotFoundError:
+            pass
+
+    def request(self, path, headers={}):
+        conn = http.client.HTTPConnection(*self.httpd.server_address)
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        conn.close()
+        return resp, body
+
+    def test_get(self):
+        resp, body = self.request("/files/report2008.pdf")
+        self.assertEqual(resp.status, 200)
+        with open(os.path.join(appie.config['target'], "files", "report2008.pdf"), 'rb') as f:
+            self.assertEqual(body, f.read())
+        self.assertTrue(resp.getheader("ETag"))
+        self.assertTrue(resp.getheader("Last-Modified"))
+        self.assertIsNone(resp.getheader("Content-Encoding"))
+
+    def test_not_modified(self):
+        resp, body = self.request("/files/report2008.pdf")
+        resp, body = self.request("/files/report2008.pdf",
+                                  {"If-None-Match": resp.getheader("ETag")})
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(body, b'')
+        resp, body = self.request("/files/report2008.pdf", {"If-None-Match": '"0-0"'})
+        self.assertEqual(resp.status, 200)
+        resp, body = self.request("/files/report2008.pdf",
+                    {"If-Modified-Since": resp.getheader("Last-Modified")})
+        self.assertEqual(resp.status, 304)
+
+    def test_gzip(self):
+        resp, body = self.request("/all.json", {"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader("Content-Encoding"), "gzip")
+        with open(os.path.join(appie.config['target'], "all.json"), 'rb') as f:
+            self.assertEqual(gzip.decompress(body), f.read())
+        plain, body = self.request("/all.json")
+        self.assertIsNone(plain.getheader("Content-Encoding"))
+        self.assertNotEqual(plain.getheader("ETag"), resp.getheader("ETag"))
+
+    def test_gzip_cache(self):
+        # only the most recently served files are kept
+        target = appie.config['target']
+        for name in ('a.txt', 'b.txt'):
+            with open(os.path.join(target, name), 'wb') as f:
+                f.write(os.urandom(1000))
+        self.httpd.gzip_cache_size = 1500
+        for name in ('a.txt', 'b.txt'):
+            resp, body = self.request("/" + name, {"Accept-Encoding": "gzip"})
+            with open(os.path.join(target, name), 'rb') as f:
+                self.assertEqual(gzip.decompress(body), f.read())
+        self.assertEqual(list(self.httpd._gzipped),
+                         [os.path.join(self.httpd.root, 'b.txt')])
+        self.assertLessEqual(self.httpd._gzipped_bytes, 1500)
+
+    def test_sidecar(self):
+        path = os.path.join(appie.config['target'], "all.json")
+        with open(path + ".br", 'wb') as f:
+            f.write(b"brotli")
+        st = os.stat(path)
+        os.utime(path + ".br", ns=(st.st_atime_ns, st.st_mtime_ns))
+        resp, body = self.request("/all.json", {"Accept-Encoding": "gzip, br"})
+        self.assertEqual(resp.getheader("Content-Encoding"), "br")
+        self.assertEqual(body, b"brotli")
+        self.assertTrue(resp.getheader("ETag").endswith('-br"'))
+        # an outdated sidecar is not used
+        os.utime(path + ".br", ns=(st.st_atime_ns, st.st_mtime_ns - 10**9))
+        resp, body = self.request("/all.json", {"Accept-Encoding": "gzip, br"})
+        self.assertEqual(resp.getheader("Content-Encoding"), "gzip")
+        with open(path, 'rb') as f:
+            self.assertEqual(gzip.decompress(body), f.read())
+
+    def test_missing(self):
+        resp, body = self.request("/nonexistent")
+        self.assertEqual(resp.status, 404)
+
+
+class AppieRebuildSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def wait_idle(self, scheduler, timeout=5):
+        end = time.monotonic() + timeout
+        while not scheduler.idle():
+            self.assertLess(time.monotonic(), end, "scheduler not idle")
+            time.sleep(0.01)
+
+    def test_coalesce(self):
+        def build(paths, moves, cancelled):
+            self.calls.append((paths, moves))
+        scheduler = AppieRebuildScheduler(build, 0.1).start()
+        try:
+            scheduler.schedule(['a'])
+            scheduler.schedule(['b'], [('c', 'd')])
+            scheduler.schedule(['a'])
+            time.sleep(0.05)
+            self.wait_idle(scheduler)
+        finally:
+            scheduler.stop()
+        self.assertEqual(self.calls, [(['a', 'b'], [('c', 'd')])])
+        self.assertEqual(scheduler.builds, 1)
+
+    def test_supersede(self):
+        started, proceed = threading.Event(), threading.Event()
+        def build(paths, moves, cancelled):
+            self.calls.append(paths)
+            if len(self.calls) == 1:
+                started.set()
+                proceed.wait(5)
+                # parsed the first path, then newer changes arrived
+                if cancelled():
+                    return paths[1:]
+            return []
+        scheduler = AppieRebuildScheduler(build, 0.05).start()
+        try:
+            scheduler.schedule(['a', 'b', 'c'])
+            self.assertTrue(started.wait(5))
+            scheduler.schedule(['d', 'b'])
+            proceed.set()
+            time.sleep(0.05)
+            self.wait_idle(scheduler)
+        finally:
+            scheduler.stop()
+        self.assertEqual(self.calls, [['a', 'b', 'c'], ['b', 'c', 'd']])
+
+    def test_failure(self):
+        def build(paths, moves, cancelled):
+            self.calls.append(paths)
+            raise ValueError("broken")
+        scheduler = AppieRebuildScheduler(build, 0.01).start()
+        try:
+            scheduler.schedule(['a'])
+            time.sleep(0.05)
+            self.wait_idle(scheduler)
+            # the scheduler keeps running
+            scheduler.schedule(['b'])
+            time.sleep(0.05)
+            self.wait_idle(scheduler)
+        finally:
+            scheduler.stop()
+        self.assertEqual(self.calls, [['a'], ['b']])
+
+
+if __name__ == '__main__':
+    unittest.main()